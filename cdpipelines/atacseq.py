@@ -1,5 +1,6 @@
 import os
 
+from general import _bedtools_genome_file
 from general import _make_dir
 from general import JobScript
 
@@ -50,12 +51,17 @@ class ATACJobScript(JobScript):
             Path to output SJ.out.tab file.
 
         """
+        # STAR's output files are prefixed with the sample name so that STAR
+        # jobs sharing a loaded genome and directory can't write over each
+        # other's files.
+        prefix = os.path.join(self.tempdir, '{}_'.format(self.sample_name))
         lines = (' \\\n\t'.join([
             star_path, 
             '--runThreadN {}'.format(threads),
             '--alignIntronMax 1',
             '--genomeDir {}'.format(star_index), 
             '--genomeLoad {}'.format(genome_load),
+            '--outFileNamePrefix {}'.format(prefix),
             '--readFilesCommand zcat',
             '--readFilesIn {} {}'.format(r1_fastq, r2_fastq),
             '--outSAMattributes All', 
@@ -70,7 +76,8 @@ class ATACJobScript(JobScript):
             '--outFilterMatchNminOverLread 0.1',
             '--outSAMtype BAM Unsorted']))
         lines += '\n\n'
-        lines += 'if [ -d _STARtmp ] ; then rm -r _STARtmp ; fi\n\n'
+        lines += ('if [ -d {0}_STARtmp ] ; then rm -r {0}_STARtmp ; '
+                  'fi\n\n'.format(prefix))
         bam = os.path.join(
             self.tempdir, '{}.bam'.format(self.sample_name))
         log_out = os.path.join(
@@ -81,14 +88,9 @@ class ATACJobScript(JobScript):
             self.tempdir, '{}_Log.progress.out'.format(self.sample_name))
         sj_out = os.path.join(
             self.tempdir, '{}_SJ.out.tab'.format(self.sample_name))
-        lines += 'mv Aligned.out.bam {}\n'.format(bam)
-        lines += 'mv Log.out {}\n'.format(log_out)
-        lines += 'mv Log.final.out {}\n'.format(log_final_out)
-        lines += 'mv Log.progress.out {}\n'.format(log_progress_out)
-        lines += 'mv SJ.out.tab {}\n'.format(sj_out)
+        lines += 'mv {}Aligned.out.bam {}\n'.format(prefix, bam)
         lines += '\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return bam, log_out, log_final_out, log_progress_out, sj_out
 
     def filter_tlen(
@@ -121,10 +123,10 @@ class ATACJobScript(JobScript):
         lines = ('{} view -h {} \\\n\t| awk \'function abs(x){{return '
                  '((x < 0.0) ? -x : x)}} {{if (abs($9) <= {}) {{print}} '
                  'else if (substr($1,1,1) == "@") {{print}}}}\' \\\n\t'
-                 '| {} view -Sb - \\\n\t> {}\n\n'.format(
-                     samtools_path, bam, tlen_max, samtools_path, out_bam))
-        with open(self.filename, "a") as f:
-            f.write(lines)
+                 '| {} view -@ {} -Sb - \\\n\t> {}\n\n'.format(
+                     samtools_path, bam, tlen_max, samtools_path,
+                     self.threads - 1, out_bam))
+        self.add_lines(lines)
         return out_bam
 
     def filter_multi_mt_blacklist_reads(
@@ -165,10 +167,10 @@ class ATACJobScript(JobScript):
             '{} view -h - \\\n\t| '.format(samtools_path) + 
             'awk \'{if (substr($1,1,1) == "@") {print} ' + 
             'else if ($1 == c1) {print prev; print}  prev=$0; c1=$1}\' ' +
-            '\\\n\t| {} view -Sb - \\\n\t> {}\n\n'.format(samtools_path, out_bam)
+            '\\\n\t| {} view -@ {} -Sb - \\\n\t> {}\n\n'.format(
+                samtools_path, self.threads - 1, out_bam)
         )
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out_bam
 
     def count_unique_mt_reads(
@@ -202,8 +204,7 @@ class ATACJobScript(JobScript):
         if bg:
             lines += ' &'
         lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out
     
     def bigwig_from_bedgraph(
@@ -254,20 +255,14 @@ class ATACJobScript(JobScript):
             dy = self.outdir
         else:
             dy = self.tempdir
-        if bedtools_path == 'bedtools':
-            genome_file = '$(which human.hg19.genome)'
-        else:
-            genome_file = os.path.join(
-                os.path.split(os.path.split(bedtools_path)[0])[0], 'genomes',
-                'human.hg19.genome')
+        genome_file = _bedtools_genome_file(bedtools_path)
         root = os.path.splitext(os.path.split(bedgraph)[1])[0]
         if tlen_max:
             root += '_{}'.format(tlen_max)
         bigwig = os.path.join(dy, '{}.bw'.format(root))
         lines = '{} \\\n\t{} \\\n\t{} \\\n\t{}\n\n'.format(
             bedGraphToBigWig_path, bedgraph, genome_file, bigwig)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         if web_available:
             name = '{}_atac'.format(self.sample_name)
             desc = 'ATACseq coverage for {}.'.format(self.sample_name)
@@ -330,8 +325,7 @@ class ATACJobScript(JobScript):
         )
         lines = 'cat <(echo "{}") {} > {}\n'.format(track_line, bed, temp_bed)
         lines += 'mv {} {}\n\n'.format(temp_bed, bed)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return bed
     
     def macs2(
@@ -401,8 +395,7 @@ class ATACJobScript(JobScript):
             out2 = os.path.join(
                 dy, '{}_peaks.gappedPeak'.format(self.sample_name))
 
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
 
         out1 = self._add_macs2_trackline(out1)
         out2 = self._add_macs2_trackline(out2)
@@ -644,8 +637,7 @@ def pipeline(
     r2_fastqs = [os.path.realpath(x) for x in r2_fastqs]
     combined_r1 = job.combine_fastqs(r1_fastqs, suffix='R1', bg=True)
     combined_r2 = job.combine_fastqs(r2_fastqs, suffix='R2', bg=True)
-    with open(job.filename, "a") as f:
-            f.write('\nwait\n\n')
+    job.add_lines('\nwait\n\n')
     # We don't want to keep the fastqs indefinitely, but we need them for the
     # fastQC step later.
     combined_r1 = job.add_output_file(combined_r1)
@@ -737,21 +729,17 @@ def pipeline(
     )
     job.add_temp_file(coord_sorted_bam)
 
-    # Index sorted bam file.
-    temp_bam_index = job.sambamba_index(coord_sorted_bam, sambamba_path)
-    job.add_temp_file(temp_bam_index)
-
-    # Mark and remove duplicates.
-    rmdup_bam, duplicate_metrics, removed_reads = job.biobambam2_mark_duplicates(
+    # Mark and remove duplicates. bammarkduplicates also indexes the rmdup bam
+    # file while writing it.
+    (rmdup_bam, duplicate_metrics, removed_reads,
+     bam_index) = job.biobambam2_mark_duplicates(
         coord_sorted_bam,
         remove_duplicates=True,
+        index=True,
         bammarkduplicates_path=bammarkduplicates_path)
     outdir_rmdup_bam = job.add_output_file(rmdup_bam)
     job.add_output_file(duplicate_metrics)
     job.add_output_file(removed_reads)
-
-    # Index rmdup bam file.
-    bam_index = job.sambamba_index(rmdup_bam, sambamba_path)
     outdir_rmdup_bam_index = job.add_output_file(bam_index)
 
     # Add softlink to bam file in outdir and write URL and trackline.
@@ -1201,10 +1189,9 @@ def pipeline(
         job.add_temp_file(reordered_bam)
 
         # Index reordered bam.
-        reordered_index = job.picard_index(
+        reordered_index = job.samtools_index(
             reordered_bam, 
-            picard_path=picard_path,
-            bg=False,
+            samtools_path=samtools_path,
         )
         job.add_temp_file(reordered_index)
 
@@ -1266,10 +1253,13 @@ def merge_samples(
     queue=None,
     tempdir=None,
     expected_unique_pairs=20000000,
+    use_samtools_merge=True,
+    merge_regions=None,
     picard_path='$picard',
     bedtools_path='bedtools',
     bedGraphToBigWig_path='bedGraphToBigWig',
     sambamba_path='sambamba',
+    samtools_path='samtools',
 ):
     """
     Make a SGE/shell scripts for merging ATAC-seq bam files and calling peaks.
@@ -1335,6 +1325,16 @@ def merge_samples(
         be normalized so that it looks like it had 20M input read pairs (i.e. 
         all coverages will be multiplied by 2).
 
+    use_samtools_merge : bool
+        If True, merge and index the bam files in one step with samtools merge
+        --write-index (requires samtools >= 1.10). Otherwise merge with
+        sambamba and index with samtools index.
+
+    merge_regions : list
+        List of regions (e.g. chromosomes) to merge in parallel when
+        use_samtools_merge is True. The input bam files must be indexed and
+        only reads in these regions are kept.
+
     picard_path : str
         Path to Picard tools.
 
@@ -1344,6 +1344,12 @@ def merge_samples(
     bedGraphToBigWig_path : str
         Path bedGraphToBigWig executable.
 
+    sambamba_path : str
+        Path to sambamba executable.
+
+    samtools_path : str
+        Path to samtools executable.
+
     Returns
     -------
     fn : str
@@ -1362,7 +1368,7 @@ def merge_samples(
         sample_name, 
         job_suffix='merge',
         outdir=os.path.join(outdir, 'merge'), 
-        threads=1, 
+        threads=4, 
         memory=4,
         linkdir=linkdir,
         webpath=webpath,
@@ -1379,19 +1385,24 @@ def merge_samples(
     for bam in bams:
         temp_bams.append(job.add_input_file(bam))
 
-    # Merge bams.
-    merged_bam = job.sambamba_merge(
-        temp_bams, 
-        sambamba_path=sambamba_path
-    )
+    # Merge and index bams.
+    if use_samtools_merge:
+        merged_bam, merged_index = job.samtools_merge(
+            temp_bams, 
+            index=True,
+            regions=merge_regions,
+            samtools_path=samtools_path,
+        )
+    else:
+        merged_bam = job.sambamba_merge(
+            temp_bams, 
+            sambamba_path=sambamba_path
+        )
+        merged_index = job.samtools_index(
+            merged_bam, 
+            samtools_path=samtools_path,
+        )
     outdir_merged_bam = job.add_output_file(merged_bam)
-
-    # Index merged bam.
-    merged_index = job.picard_index(
-        merged_bam, 
-        picard_path=picard_path,
-        bg=False,
-    )
     outdir_merged_index = job.add_output_file(merged_index)
 
     # Add softlink to bam file in outdir and write URL and trackline.
@@ -1418,7 +1429,7 @@ def merge_samples(
         sample_name, 
         job_suffix='bigwig',
         outdir=os.path.join(outdir, 'bigwig'), 
-        threads=1, 
+        threads=4, 
         memory=4,
         linkdir=linkdir,
         webpath=webpath,
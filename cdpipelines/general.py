@@ -1,27 +1,135 @@
 import os
-import subprocess
+
+# Cached result of _git_info(). The git version can't change while we're
+# making scripts so we only need to ask git once per process. If we ever need
+# to ask git more than one question per process, it would be worth keeping a
+# single git cat-file --batch process open rather than starting git each time.
+_GIT_INFO = None
 
 def _git_info():
     """Get current git version"""
-    # Necessary to pipe to cat because git will open the result in less
-    # otherwise.
+    global _GIT_INFO
+    if _GIT_INFO is not None:
+        return _GIT_INFO
+    # These are only needed here, and this only runs once per process, so
+    # they're imported here to keep importing this module cheap.
+    from distutils.spawn import find_executable
+    import subprocess
+    git = find_executable('git')
+    if git is None:
+        _GIT_INFO = ''
+        return _GIT_INFO
     d = os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[0:-2] +
                          ['.git'])
-    command = ('git --git-dir {0} log -1 --pretty=oneline --decorate | '
-               'cat'.format(d))
-    res = subprocess.Popen(command, shell=True,
-                           stdout=subprocess.PIPE).communicate()
-    res = res[0][:-1].strip() 
-    return res 
+    # git doesn't use a pager when stdout isn't a terminal so there's no need
+    # to pipe through cat.
+    with open(os.devnull, 'w') as devnull:
+        try:
+            out = subprocess.check_output(
+                [git, '--git-dir', d, 'log', '-1', '--pretty=oneline',
+                 '--decorate'], stderr=devnull)
+        except subprocess.CalledProcessError:
+            out = ''
+    _GIT_INFO = out.strip()
+    return _GIT_INFO
+
+def _softlink_lines(target, link):
+    """Get lines to make softlink from target to link."""
+    return 'ln -s \\\n\t' + target + ' \\\n\t' + link + '\n\n'
+
+# Header for the SGE shell scripts. The queue, modules, conda, and tempdir
+# fields are either empty or complete lines.
+_SGE_HEADER = (
+    '#!/bin/bash\n\n'
+    '{queue}'
+    '#$ -N {jobname}\n'
+    '#$ -l h_vmem={vmem}G\n'
+    '#$ -pe smp {threads}\n'
+    '#$ -S /bin/bash\n'
+    '#$ -o {out}\n'
+    '#$ -e {err}\n\n'
+    '# Git repository version:\n'
+    '# {git}\n\n'
+    '{modules}'
+    '{conda}'
+    '{tempdir}'
+)
+
+# Beginning of the command for running a java jar file (e.g. Picard or GATK).
+# Format with the maximum heap size in Gb, the number of garbage collection
+# threads, the temp directory, and the jar file (followed by the tool name for
+# Picard).
+_JAVA_JAR_COMMAND = ' \\\n\t'.join([
+    'java -Xmx{memory}g',
+    '-XX:+UseParallelGC -XX:ParallelGCThreads={gc_threads}',
+    '-Djava.io.tmpdir={tempdir}{options}',
+    '-jar {jar}',
+])
+
+# htsjdk options for Picard. Asynchronous IO moves BGZF reading and writing
+# off of the main thread.
+_PICARD_JAVA_OPTIONS = ' \\\n\t'.join([
+    '-Dsamjdk.use_async_io_read_samtools=true',
+    '-Dsamjdk.use_async_io_write_samtools=true',
+])
+
+# awk program that turns bcftools query output for the het sites (first file)
+# and the pileup at those sites (second file) into a table with the same
+# leading columns as GATK's ASEReadCounter output. The pileup lists the ref
+# allele depth first in AD followed by the depths for the observed alleles in
+# ALT, so the VCF's alt allele is looked up by name.
+_ALLELE_COUNTS_AWK = ' '.join([
+    'BEGIN {FS = OFS = "\\t"; print "contig", "position", "variantID",',
+    '"refAllele", "altAllele", "refCount", "altCount", "totalCount"}',
+    'NR == FNR {site[$1 ":" $2] = $3 OFS $4 OFS $5; alt[$1 ":" $2] = $5;',
+    'next}',
+    '($1 ":" $2) in site {n = split($3, alts, ","); split($4, ad, ",");',
+    'a = 0; for (i = 1; i <= n; i++) if (alts[i] == alt[$1 ":" $2])',
+    'a = ad[i + 1]; print $1, $2, site[$1 ":" $2], ad[1], a, ad[1] + a}',
+])
+
+# awk program that reads a bam header and prints the regions (given as a
+# space-separated awk variable) ordered by their sequence's @SQ line so the
+# merged parts can be concatenated in coordinate order. A region is a sequence
+# name, optionally followed by a :start-end range. Regions on the same sequence
+# keep the order they were given in.
+_REGION_ORDER_AWK = ' '.join([
+    'BEGIN {FS = "\\t"; n = split(regions, r, " ")}',
+    '$1 == "@SQ" {for (i = 2; i <= NF; i++) if ($i ~ /^SN:/)',
+    'idx[substr($i, 4)] = ++k}',
+    'END {for (i = 1; i <= n; i++) {c = r[i]; if (!(c in idx))',
+    'sub(/:[^:]*$/, "", c); if (c in idx) print idx[c], i, r[i];',
+    'else print "Region not in header: " r[i] > "/dev/stderr"}}',
+])
+
+def _bedtools_genome_file(bedtools_path):
+    """Get the path to the human.hg19.genome file that comes with bedtools. If
+    bedtools_path is just 'bedtools', the genome file is assumed to be in your
+    path as well."""
+    if bedtools_path == 'bedtools':
+        return '$(which human.hg19.genome)'
+    return os.path.join(os.path.dirname(os.path.dirname(bedtools_path)),
+                        'genomes', 'human.hg19.genome')
 
 def _make_dir(d):
-    """Make directory d if it doesn't exist"""
-    try:
+    """Make directory d if it doesn't exist. Nothing is done if d is None."""
+    if d is not None and not os.path.isdir(d):
         os.makedirs(d)
-    except OSError:
-        pass
 
 class JobScript:
+    # Suffixes of the files that CollectMultipleMetrics writes.
+    _MULTI_METRIC_SUFFIXES = (
+        'alignment_summary_metrics',
+        'quality_by_cycle.pdf',
+        'base_distribution_by_cycle.pdf',
+        'quality_by_cycle_metrics',
+        'base_distribution_by_cycle_metrics',
+        'quality_distribution.pdf',
+        'insert_size_histogram.pdf',
+        'quality_distribution_metrics',
+        'insert_size_metrics',
+    )
+
     def __init__(
         self, 
         sample_name, 
@@ -37,6 +145,7 @@ class JobScript:
         modules=None, 
         wait_for=None, 
         copy_input=False,
+        java_processes=1,
     ):
         """
         Create SGE/shell script object.
@@ -90,6 +199,11 @@ class JobScript:
         copy_input : bool
             Whether to copy input files to temp directory. 
 
+        java_processes : int
+            Number of java processes (e.g. Picard tools run in the background)
+            that the script runs at the same time. Each JVM gets an equal
+            share of the job's memory and threads.
+
         """
         # Sample name used for naming files.
         self.sample_name = sample_name
@@ -99,18 +213,29 @@ class JobScript:
         self.jobname = 'job_{}_{}'.format(sample_name, job_suffix)
         # Directory for storing output files.
         self.outdir = outdir
+        # The logs and sh directories are made next to outdir.
+        parent = os.path.dirname(outdir)
+        self._logs_dir = os.path.join(parent, 'logs')
+        self._sh_dir = os.path.join(parent, 'sh')
         # Directory for storing temp files. The job is executed in this
         # directory.
         if tempdir:
             self.tempdir = os.path.realpath(os.path.join(tempdir, self.jobname))
         else:
             self.tempdir = self.outdir
+        # Prefix for temp files named after the sample.
+        self._tmp_sample_prefix = os.path.join(self.tempdir, sample_name + '_')
+        # Whether the temp directory and output directory are the same. If so,
+        # we don't need to copy output files or remove the temp directory at
+        # the end of the job.
+        self._tempdir_is_outdir = (os.path.realpath(self.tempdir) ==
+                                   os.path.realpath(self.outdir))
         _make_dir(self.outdir)
+        if not (isinstance(threads, int) and isinstance(memory, int)):
+            raise TypeError('threads and memory must be ints')
         # Number of threads to request for job from SGE.
-        assert type(threads) is int
         self.threads = threads
         # Amount of memory to request for job from SGE.
-        assert type(memory) is int
         self.memory = memory
         # Directory to make softlinks in.
         _make_dir(linkdir)
@@ -129,15 +254,17 @@ class JobScript:
         else:
             self.modules = None
         # Make directory to store stdout and stderr files. 
-        _make_dir(os.path.join(os.path.split(outdir)[0], 'logs'))
-        self.out = os.path.join(os.path.split(self.outdir)[0], 'logs',
+        _make_dir(self._logs_dir)
+        self.out = os.path.join(self._logs_dir,
                                 '{}.out'.format(self.jobname))
-        self.err = os.path.join(os.path.split(self.outdir)[0], 'logs',
+        self.err = os.path.join(self._logs_dir,
                                 '{}.err'.format(self.jobname))
         # List of job names to wait for when submitting to SGE.
         self.wait_for = wait_for
         # Whether to copy input files to tempdir.
         self.copy_input = copy_input
+        # Number of JVMs that run at the same time.
+        self.java_processes = java_processes
         # List of input files to copy to tempdir.
         self._input_files_to_copy = []
         # List of output files to copy from tempdir to outdir at end of job.
@@ -148,83 +275,163 @@ class JobScript:
         # List of [target, link_name] pairs to create softlinks for at the end
         # of the shell script.
         self._softlinks = []
-        # Whether to delete shell script after we create it.
+        # Whether to skip writing the shell script. This is set if the shell
+        # script already exists.
         self.delete_sh = False
+        # Number of tasks if this is an SGE array job (see run_array_tasks).
+        self._array_tasks = None
         # File to write web URLs and tracklines to.
         self.links_tracklines = os.path.join(
             self.outdir, '{}_links_tracklines.txt'.format(self.sample_name))
         # Set shell script file name.
         self._set_filename()
+        # Lines of the shell script. These are collected as the job is built
+        # and written to self.filename all at once in write_end().
+        self._lines = []
         # Write shell/SGE header.
         self._write_header()
 
     def _set_filename(self):
         """Make SGE/shell script filename. If a shell script already exists, the
-        current shell script will be stored as a temp file."""
-        _make_dir(os.path.join(os.path.split(self.outdir)[0], 'sh'))
-        self.filename = os.path.join(os.path.split(self.outdir)[0], 'sh',
+        current shell script will not be written."""
+        _make_dir(self._sh_dir)
+        self.filename = os.path.join(self._sh_dir,
                                      '{}.sh'.format(self.jobname[4:]))
         # If the shell script already exists we'll assume that the script is
-        # just being created to get the output filenames etc. so we'll write to
-        # a temp file.
+        # just being created to get the output filenames etc. so we won't
+        # write it.
         if os.path.exists(self.filename):
-            import tempfile
-            self.filename = tempfile.NamedTemporaryFile(delete=False).name
             self.delete_sh = True
     
+    def add_lines(self, lines):
+        """Add lines to the shell script."""
+        self._lines.append(lines)
+
+    def _sort_memory(self, fraction=0.8):
+        """Get the memory per thread for samtools sort -m so that the threads
+        together use fraction of the job's memory."""
+        return '{}M'.format(
+            max(int(self.memory * fraction * 1024 / self.threads), 1))
+
+    def _java_memory(self):
+        """Get the maximum heap size in Gb for java. The JVMs share 80% of the
+        job's memory."""
+        return max(int(self.memory * 0.8 / self.java_processes), 1)
+
+    def _java_jar_command(self, jar, args, java_options=None):
+        """Get command to run jar file with arguments args. The JVM uses up to
+        four of its share of the job's threads for parallel garbage collection
+        and uses the temp directory. java_options are extra JVM options placed
+        before -jar."""
+        options = ''
+        if java_options:
+            options = ' \\\n\t' + java_options
+        gc_threads = min(max(self.threads / self.java_processes, 1), 4)
+        return (_JAVA_JAR_COMMAND.format(memory=self._java_memory(),
+                                         gc_threads=gc_threads,
+                                         tempdir=self.tempdir, options=options,
+                                         jar=jar) +
+                ''.join([' \\\n\t' + x for x in args]))
+
+    def _picard_command(self, tool, picard_path, args):
+        """Get command to run Picard tool with arguments args."""
+        return self._java_jar_command('{} {}'.format(picard_path, tool), args,
+                                      java_options=_PICARD_JAVA_OPTIONS)
+
     def _write_header(self):
-        with open(self.filename, "a") as f:
-            f.write('#!/bin/bash\n\n')
-            if self.queue:
-                f.write('#$ -l {}\n'.format(self.queue))
-            f.write('#$ -N {}\n'.format(self.jobname))
-            f.write('#$ -l h_vmem={}G\n'.format(
-                self.memory / float(self.threads)))
-            f.write('#$ -pe smp {}\n'.format(self.threads))
-            f.write('#$ -S /bin/bash\n')
-            f.write('#$ -o {}\n'.format(self.out))
-            f.write('#$ -e {}\n\n'.format(self.err))
-            if self.modules:
-                for module in self.modules:
-                    f.write('module load {}\n\n'.format(module))
-            if self.conda_env:
-                f.write('source activate {}\n\n'.format(self.conda_env))
-            if self.tempdir:
-                f.write('mkdir -p {}\n'.format(self.tempdir))
-                f.write('cd {}\n\n'.format(self.tempdir))
+        self.add_lines(self._header())
+
+    def _header(self):
+        """Get the shell/SGE header for the script."""
+        queue = ''
+        if self.queue:
+            queue = '#$ -l ' + self.queue + '\n'
+        modules = ''
+        if self.modules:
+            modules = ''.join(['module load ' + m + '\n\n' for m in
+                               self.modules])
+        conda = ''
+        if self.conda_env:
+            conda = 'source activate ' + self.conda_env + '\n\n'
+        tempdir = ''
+        if self.tempdir:
+            tempdir = ('mkdir -p ' + self.tempdir + '\n' +
+                       'cd ' + self.tempdir + '\n\n')
+        return _SGE_HEADER.format(
+            queue=queue, jobname=self.jobname,
+            vmem=str(self.memory / float(self.threads)), threads=self.threads,
+            out=self.out, err=self.err, git=_git_info(), modules=modules,
+            conda=conda, tempdir=tempdir)
+
+    def _stage(self, files, dest):
+        """Get lines to put copies of files into directory dest. Each file is
+        hardlinked if dest is on the same filesystem so no data is copied.
+        Otherwise it's copied with cp --reflink=auto, which is a copy-on-write
+        clone on filesystems that support it and a normal copy elsewhere."""
+        parts = ['while read f ; do ln -f "$f" ', dest, ' 2> /dev/null || ',
+                 'cp --reflink=auto "$f" ', dest, " ; done <<'EOF'\n"]
+        parts.extend([x + '\n' for x in files])
+        parts.append('EOF\n\n')
+        return ''.join(parts)
 
     def _copy_output_files(self):
-        if (len(self._output_files_to_copy) > 0 and 
-            os.path.realpath(self.tempdir) != os.path.realpath(self.outdir)):
-            with open(self.filename, "a") as f:
-                f.write('rsync -avz \\\n\t{} \\\n \t{}\n\n'.format( 
-                    '\\\n\t'.join(self._output_files_to_copy),
-                    self.outdir))
+        """Move output files into the output directory if it's on the same
+        filesystem as the temp directory (a rename, so no data is copied).
+        Otherwise copy them with rsync. The temp directory is deleted right
+        after this so the outputs aren't needed there anymore."""
+        if self._tempdir_is_outdir:
+            return
+        # The script runs in the temp directory, so relative paths are
+        # relative to it. Some outputs are written straight to self.outdir.
+        # Those are already in place (and mv would fail on them).
+        outdir = os.path.realpath(self.outdir)
+        files = [os.path.join(self.tempdir, x) for x in
+                 self._output_files_to_copy]
+        files = [x for x in files if
+                 os.path.realpath(os.path.dirname(x)) != outdir]
+        if len(files) > 0:
+            # The same list of files is given on stdin to whichever command
+            # runs. mv can't replace a directory that isn't empty (e.g. from an
+            # earlier run), so an existing output directory is removed first.
+            parts = ['if [ "$(stat -c %d ', self.tempdir, ')" = ',
+                     '"$(stat -c %d ', self.outdir, ')" ] ; then\n',
+                     '\twhile read -r f ; do\n',
+                     '\t\td=', self.outdir, '/"$(basename "$f")"\n',
+                     '\t\tif [ -d "$f" ] && [ -d "$d" ] ; then rm -r "$d" ; '
+                     'fi\n',
+                     '\t\tmv -f "$f" ', self.outdir, '\n',
+                     '\tdone\nelse\n',
+                     '\trsync -avrW --inplace --no-relative --files-from=- / ',
+                     self.outdir, "\nfi <<'EOF'\n"]
+            parts.extend([x + '\n' for x in files])
+            parts.append('EOF\n\n')
+            self.add_lines(''.join(parts))
 
     def _delete_temp_files(self):
+        if self._tempdir_is_outdir:
+            # Don't delete output files that are already in their final
+            # location.
+            output = set(self._output_files_to_copy)
+            self._temp_files_to_delete = [
+                x for x in self._temp_files_to_delete if x not in output
+            ]
         if len(self._temp_files_to_delete) > 0:
-            if (os.path.realpath(self.tempdir) == os.path.realpath(self.outdir) 
-                or self.tempdir is None):
-                self._temp_files_to_delete = [
-                    x for x in self._temp_files_to_delete if x not in
-                    self._output_files_to_copy
-                ]
-            with open(self.filename, "a") as f:
-                f.write('rm -r \\\n\t{}\n\n'.format(
-                    ' \\\n\t'.join(list(set(self._temp_files_to_delete)))))
+            parts = ['rm -r']
+            parts.extend([' \\\n\t' + x for x in
+                          set(self._temp_files_to_delete)])
+            parts.append('\n\n')
+            self.add_lines(''.join(parts))
 
     def _delete_tempdir(self):
-        if self.tempdir and (os.path.realpath(self.tempdir) !=
-                             os.path.realpath(self.outdir)):
-            with open(self.filename, "a") as f:
-                f.write('rm -r {}\n'.format(self.tempdir))
+        if not self._tempdir_is_outdir:
+            self.add_lines('rm -r ' + self.tempdir + '\n')
 
     def _make_softlinks(self):
         """Softlinks are made at the end of shell script when all of the files
         are in their final locations."""
-        with open(self.filename, "a") as f:
-            for p in self._softlinks:
-                self.softlink(p[0], p[1])
+        if len(self._softlinks) > 0:
+            self.add_lines(''.join([_softlink_lines(p[0], p[1]) for p in
+                                    self._softlinks]))
 
     def softlink(self, target, link):
         """
@@ -244,9 +451,7 @@ class JobScript:
             Full path to softlink.
     
         """
-        lines = 'ln -s \\\n\t{} \\\n\t{}\n\n'.format(target, link)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(_softlink_lines(target, link))
         return link
     
     def add_softlink(self, target, link_name=None):
@@ -260,7 +465,7 @@ class JobScript:
     
         Parameters
         ----------
-        fn : str
+        target : str
             Full path to file to make link to.
     
         link_name : str
@@ -272,22 +477,24 @@ class JobScript:
             Path to softlink.
     
         """
-        if self.sample_name not in os.path.split(target)[1]:
-            name = '{}_{}'.format(self.sample_name, os.path.split(target)[1])
-            link = os.path.join(self.linkdir, name)
+        if link_name:
+            link = link_name
         else:
-            name = os.path.split(target)[1]
+            name = os.path.basename(target)
+            if self.sample_name not in name:
+                name = '{}_{}'.format(self.sample_name, name)
             link = os.path.join(self.linkdir, name)
         self._softlinks.append([target, link])
         return link
 
     def sge_submit_command(self):
         """Get command to submit script."""
+        c = 'qsub'
+        if self._array_tasks:
+            c += ' -t 1-{}'.format(self._array_tasks)
         if self.wait_for:
-            return 'qsub -hold_jid {} {}'.format(','.join(self.wait_for),
-                                                 self.filename)
-        else:
-            return 'qsub {}'.format(self.filename)
+            c += ' -hold_jid {}'.format(','.join(self.wait_for))
+        return '{} {}'.format(c, self.filename)
 
     def add_input_file(self, fn, copy=None, delete_original=False):
         """
@@ -342,22 +549,65 @@ class JobScript:
 
     def copy_input_files(self):
         if len(self._input_files_to_copy) > 0:
-            with open(self.filename, "a") as f:
-                f.write('rsync -avz \\\n\t{} \\\n \t{}\n\n'.format( 
-                    '\\\n\t'.join(self._input_files_to_copy),
-                    self.tempdir))
+            self.add_lines(self._stage(
+                [os.path.realpath(x) for x in self._input_files_to_copy],
+                self.tempdir))
             # We will delete any input files from the temp directory that we
             # copy over.
-            self.temp_files_to_delete += [
+            self._temp_files_to_delete += [
                 self.temp_file_path(x) for x in self._input_files_to_copy]
 
+    def wait_for_background(self, pids, fifos=None):
+        """
+        Wait for background processes and exit if any of them fail. A bare wait
+        discards the processes' exit statuses, and a process that dies before
+        opening a named pipe leaves the process at the other end blocked in
+        open() forever. Instead, the processes are polled and if one fails the
+        others are killed, the named pipes are removed, and the script exits.
+    
+        Parameters
+        ----------
+        pids : list
+            Names of the shell variables that hold the PIDs of the processes
+            (i.e. each was set to $! after starting its process).
+
+        fifos : list
+            Paths to the named pipes the processes read from and write to.
+            These are removed whether or not the processes succeed.
+    
+        """
+        rm = ''
+        if fifos:
+            rm = 'rm -f {}\n'.format(' '.join(fifos))
+        lines = [
+            'pids="{}"\n'.format(' '.join(['$' + x for x in pids])),
+            'while [ -n "$pids" ] ; do\n',
+            '\trunning=""\n',
+            '\tfor pid in $pids ; do\n',
+            '\t\tif kill -0 $pid 2> /dev/null ; then\n',
+            '\t\t\trunning="$running $pid"\n',
+            '\t\telif ! wait $pid ; then\n',
+            '\t\t\tfor p in $pids ; do pkill -P $p ; kill $p ; done '
+            '2> /dev/null\n',
+            '\t\t\t' + rm if rm else '',
+            '\t\t\texit 1\n',
+            '\t\tfi\n',
+            '\tdone\n',
+            '\tpids=$running\n',
+            '\tif [ -n "$pids" ] ; then sleep 1 ; fi\n',
+            'done\n\n',
+            rm + '\n' if rm else '',
+        ]
+        self.add_lines(''.join(lines))
+
     def write_end(self):
         self._copy_output_files()
         self._delete_temp_files()
         self._delete_tempdir()
         self._make_softlinks()
-        if self.delete_sh:
-            os.remove(self.filename)
+        if not self.delete_sh:
+            with open(self.filename, "w") as f:
+                f.write(''.join(self._lines))
 
     def make_het_vcf(
         vcf, 
@@ -407,19 +657,135 @@ class JobScript:
             lines += '-Ou \\\n\t| {} annotate --rename-chrs {} '.format(
                 bcftools_path, vcf_chrom_conv)
         lines += '> {}'.format(vcf_out)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return vcf_out
 
+    def sample_vcf(
+        self,
+        vcf,
+        vcf_sample_name,
+        bg=False,
+        bcftools_path='bcftools',
+    ):
+        """
+        Make an indexed VCF with only the genotypes for one sample. Every
+        record is kept, including those where the sample is homozygous
+        reference or has no call, so code that walks the records (e.g. the
+        nearby variant filter in make_mbased_input) sees the same records as
+        it would in the full VCF.
+    
+        Parameters
+        ----------
+        vcf : str
+            Path to gzipped VCF file.
+    
+        vcf_sample_name : str
+            Sample name of this sample in the VCF file.
+    
+        bg : boolean
+            Whether to run the process in the background.
+
+        Returns
+        -------
+        out : str
+            Path to output gzipped VCF file.
+    
+        out_index : str
+            Path to tabix index for output VCF file.
+    
+        """
+        out = os.path.join(self.tempdir, '{}_{}'.format(
+            vcf_sample_name, os.path.basename(vcf)))
+        out_index = out + '.tbi'
+        lines = ('{0} view -Oz -s {1} \\\n\t-o {2} \\\n\t{3} '
+                 '\\\n\t&& {0} index -t {2}'.format(
+                     bcftools_path, vcf_sample_name, out, vcf))
+        if bg:
+            lines += ' &\n\n'
+        else:
+            lines += '\n\n'
+        self.add_lines(lines)
+        return out, out_index
+
     def make_md5sum(
         self,
         fn,
     ):
         """Make an md5sum for fn. Returns path to md5 file."""
-        lines = 'md5sum {0} > {0}.md5\n\n'.format(fn)
-        with open(self.filename, "a") as f:
-            f.write(lines)
-        return fn + '.md5'
+        md5 = fn + '.md5'
+        self.add_lines('md5sum ' + fn + ' > ' + md5 + '\n\n')
+        return md5
+
+    def run_scripts(
+        self,
+        scripts, 
+        jobs=None,
+        parallel_path='parallel',
+    ):
+        """
+        Run several job scripts from this job using GNU parallel. This is useful
+        for running many short per-sample jobs (e.g. flagstat) as a single SGE
+        job so we don't wait in the queue for each one. The scripts should
+        already be written (i.e. write_end should have been called).
+    
+        Parameters
+        ----------
+        scripts : list
+            List of paths to shell scripts to run. The SGE options in the
+            scripts are ignored since they are run with bash.
+    
+        jobs : int
+            Number of scripts to run at once. Defaults to the number of threads
+            for this job.
+    
+        parallel_path : str
+            Path to GNU parallel executable.
+    
+        """
+        if jobs is None:
+            jobs = self.threads
+        lines = '{} --jobs {} bash ::: \\\n\t{}\n\n'.format(
+            parallel_path, jobs, ' \\\n\t'.join(scripts))
+        self.add_lines(lines)
+
+    def run_array_tasks(
+        self,
+        scripts, 
+    ):
+        """
+        Run each of several job scripts as one task of an SGE array job. Unlike
+        run_scripts, each script gets its own task (and the resources requested
+        for this job) but the scripts are still submitted and queued as a single
+        job. sge_submit_command will request one task per script. The scripts
+        should already be written (i.e. write_end should have been called).
+        This should be called before any other lines are added to this job
+        because it changes the temp directory and log files.
+    
+        Parameters
+        ----------
+        scripts : list
+            List of paths to shell scripts to run. The SGE options in the
+            scripts are ignored since they are run with bash.
+    
+        """
+        self._array_tasks = len(scripts)
+        # The tasks run at the same time, so each task gets its own temp
+        # directory and stdout/stderr files. SGE replaces $TASK_ID in the log
+        # paths.
+        if not self._tempdir_is_outdir:
+            self.tempdir = '{}_$SGE_TASK_ID'.format(self.tempdir)
+            self._tmp_sample_prefix = os.path.join(self.tempdir,
+                                                   self.sample_name + '_')
+        self.out = os.path.join(self._logs_dir,
+                                '{}.$TASK_ID.out'.format(self.jobname))
+        self.err = os.path.join(self._logs_dir,
+                                '{}.$TASK_ID.err'.format(self.jobname))
+        self._lines[0] = self._header()
+        lines = ['case $SGE_TASK_ID in\n']
+        for i, script in enumerate(scripts):
+            lines.append('\t{}) bash {} ;;\n'.format(i + 1, script))
+        lines.append('esac\n\n')
+        self.add_lines(''.join(lines))
 
     def merge_bed(
         self,
@@ -431,8 +797,7 @@ class JobScript:
         out_bed = os.path.join(self.tempdir, '{}_merged.bed'.format(root))
         lines = '{0} sort -i {1} | {0} merge -i stdin > {2}'.format(
             bedtools_path, bed, out_bed)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out_bed
 
     def convert_sra_to_fastq(
@@ -516,8 +881,7 @@ class JobScript:
         # Remove raw fastq files from fastq-dump.
         lines += 'rm \\\n\t{}\n\n'.format(' \\\n\t'.join(temp_files))
     
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return r1, r2
 
     def homer_motif_analysis(
@@ -567,8 +931,7 @@ class JobScript:
             lines += ' \\\n\t-mask'
         lines += '\n\n'
         
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         
         if web_available:
             link = self.add_softlink(dy)
@@ -625,8 +988,7 @@ class JobScript:
         out_bg = os.path.join(self.tempdir, '{}_scaled.bg'.format(root))
         lines = 'scale_bedgraph \\\n\t{} \\\n\t{} \\\n\t{} \\\n\t{}\n\n'.format(
             bg, bam, out_bg, expected_num)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out_bg
 
     def featureCounts_count(
@@ -706,8 +1068,7 @@ class JobScript:
                 features, out, bam)
         else:
             assert True == False
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out, out_summary
 
     def convert_bed_to_saf(
@@ -731,8 +1092,7 @@ class JobScript:
         saf = os.path.join(self.tempdir,
                            os.path.splitext(os.path.split(bed)[1])[0] + '.saf')
         lines = 'convert_bed_to_saf \\\n\t{} \\\n\t{}\n\n'.format(bed, saf)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return saf
 
     def bedgraph_from_bam(
@@ -755,6 +1115,10 @@ class JobScript:
             Path to bedtools. If bedtools_path == 'bedtools', it is assumed that
             the hg19 human.hg19.genome file from bedtools is also in your path.
 
+        sambamba_path : str
+            Path to sambamba executable. sambamba view uses all of the job's
+            threads to decompress the bam file.
+
         Returns
         -------
         bedgraph : str
@@ -763,22 +1127,16 @@ class JobScript:
         """
         bedgraph = os.path.join(self.tempdir, '{}.bg'.format(self.sample_name))
 
-        if bedtools_path == 'bedtools':
-            genome_file = 'human.hg19.genome'
-        else:
-            genome_file = os.path.join(
-                os.path.split(os.path.split(bedtools_path)[0])[0], 'genomes',
-                'human.hg19.genome')
+        genome_file = _bedtools_genome_file(bedtools_path)
 
-        lines = ('{} view -f bam -F "not (unmapped or mate_is_unmapped) and '
-                 'mapping_quality >= 255" \\\n\t{} \\\n\t| '
+        lines = ('{} view -t {} -f bam -F "not (unmapped or mate_is_unmapped) '
+                 'and mapping_quality >= 255" \\\n\t{} \\\n\t| '
                  '{} genomecov -ibam stdin \\\n\t-g {} -split -bg \\\n\t'
                  '-trackline -trackopts \'name="{}"\' '.format(
-                     sambamba_path, bam, bedtools_path, genome_file,
-                     self.sample_name))
+                     sambamba_path, self.threads, bam, bedtools_path,
+                     genome_file, self.sample_name))
         lines += ' \\\n\t> {}\n\n'.format(bedgraph)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return bedgraph
     
     def picard_collect_rna_seq_metrics(
@@ -821,32 +1179,25 @@ class JobScript:
             Path to output PDF file.
     
         """
-        metrics = os.path.join(self.tempdir,
-                               '{}_rna_seq_metrics.txt'.format(self.sample_name))
-        chart = os.path.join(self.tempdir,
-                             '{}_5_3_coverage.pdf'.format(self.sample_name))
+        metrics = self._tmp_sample_prefix + 'rna_seq_metrics.txt'
+        chart = self._tmp_sample_prefix + '5_3_coverage.pdf'
         if strand_specific:
             ss = 'SECOND_READ_TRANSCRIPTION_STRAND'
         else:
             ss = 'NONE'
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar '.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} CollectRnaSeqMetrics'.format(picard_path),
+        lines = self._picard_command('CollectRnaSeqMetrics', picard_path, [
             'I={}'.format(in_bam),
             'REF_FLAT={}'.format(ref_flat),
             'STRAND_SPECIFICITY={}'.format(ss),
             'RIBOSOMAL_INTERVALS={}'.format(rrna_intervals),
             'ASSUME_SORTED=TRUE',
             'CHART_OUTPUT={}'.format(chart),
-            'O={}'.format(metrics)]))
+            'O={}'.format(metrics)])
         if bg:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return metrics, chart
 
     def picard_collect_multiple_metrics(
@@ -882,33 +1233,18 @@ class JobScript:
                 insert_size_metrics.
     
         """
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar '.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} CollectMultipleMetrics'.format(picard_path),
+        lines = self._picard_command('CollectMultipleMetrics', picard_path, [
             'VALIDATION_STRINGENCY=SILENT',
             'ASSUME_SORTED=TRUE',
             'I={}'.format(in_bam), 
-            'O={}'.format(self.sample_name)]))
+            'O={}'.format(self.sample_name)])
         if bg:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
-        output = [os.path.join(self.tempdir, '{}.{}'.format(self.sample_name, x))
-                               for x in [
-                                   'alignment_summary_metrics',
-                                   'quality_by_cycle.pdf',
-                                   'base_distribution_by_cycle.pdf',
-                                   'quality_by_cycle_metrics',
-                                   'base_distribution_by_cycle_metrics',
-                                   'quality_distribution.pdf',
-                                   'insert_size_histogram.pdf',
-                                   'quality_distribution_metrics',
-                                   'insert_size_metrics']]
-        return tuple(output)
+        self.add_lines(lines)
+        prefix = os.path.join(self.tempdir, self.sample_name + '.')
+        return tuple([prefix + x for x in self._MULTI_METRIC_SUFFIXES])
     
     def sambamba_index(
         self,
@@ -935,8 +1271,7 @@ class JobScript:
         index = os.path.join(self.tempdir, os.path.split(in_bam)[1] + '.bai')
         lines = '{} index -t {} \\\n\t{} \\\n\t{}\n\n'.format(
             sambamba_path, self.threads, in_bam, index)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return index
     
     def sambamba_merge(
@@ -964,10 +1299,114 @@ class JobScript:
         out = os.path.join(self.tempdir, '{}.bam'.format(self.sample_name))
         lines = '{} merge -t {} \\\n\t{} \\\n\t{}\n\n'.format(
             sambamba_path, self.threads, out, ' \\\n\t'.join(bams))
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out
     
+    def samtools_merge(
+        self,
+        bams, 
+        index=False,
+        regions=None,
+        bg=False,
+        samtools_path='samtools',
+        parallel_path='parallel',
+    ):
+        """
+        Merge coordinate sorted bam files using samtools. Compression uses all
+        of the job's threads.
+    
+        Parameters
+        ----------
+        bams : list
+            List of paths to bam files to merge.
+    
+        index : bool
+            If True, index the merged bam file as it is written (requires
+            samtools >= 1.10). Otherwise any samtools version can be used; the
+            output file is given positionally because older versions of
+            samtools merge don't have -o.
+
+        regions : list
+            List of regions (e.g. chromosomes). If provided, each region is
+            merged separately (one region per thread using GNU parallel) and the
+            parts are concatenated. samtools cat keeps the parts in the order
+            they're given, so the regions are put in the order of the first bam
+            file's @SQ header lines when the job runs (regions on the same
+            sequence keep the order given). Each region must be a sequence
+            name from the header, optionally with a :start-end range, and all of
+            the input bam files must have their sequences in the same order.
+            The input bam files must be indexed and reads outside of these
+            regions (including unmapped reads) are not included in the output.
+
+        bg : boolean
+            Whether to run the process in the background.
+    
+        samtools_path : str
+            Path to samtools executable.
+    
+        parallel_path : str
+            Path to GNU parallel executable. Only used if regions is provided.
+    
+        Returns
+        -------
+        out : str
+            Path to output merged bam file.
+    
+        out_index : str
+            Path to output index file. Only returned if index == True.
+    
+        """
+        if regions and bg:
+            raise ValueError('Merging by region cannot be run in the '
+                             'background.')
+        out = os.path.join(self.tempdir, '{}.bam'.format(self.sample_name))
+        out_index = out + '.bai'
+        if regions:
+            parts = [os.path.join(self.tempdir, '{}_region_{}.bam'.format(
+                self.sample_name, i + 1)) for i in range(len(regions))]
+            part = os.path.join(self.tempdir,
+                                '{}_region_{{#}}.bam'.format(self.sample_name))
+            # The parts are concatenated in the order the regions are given
+            # to parallel, so the regions are put in the header's order when
+            # the job runs.
+            commands = [
+                'regions=$({} view -H {} \\\n\t| awk -v regions=\'{}\' '
+                '\\\n\t\'{}\' \\\n\t| sort -k1,1n -k2,2n '
+                '| cut -d \' \' -f 3)'.format(
+                    samtools_path, bams[0], ' '.join(regions),
+                    _REGION_ORDER_AWK),
+                'if [ "$(echo $regions | wc -w)" -ne {} ] ; then exit 1 ; '
+                'fi'.format(len(regions)),
+                '{} --jobs {} \\\n\t{} merge -c -p -R {{}} {} \\\n\t{} '
+                '\\\n\t::: $regions'.format(parallel_path, self.threads,
+                                          samtools_path, part, ' '.join(bams)),
+                '{} cat -o {} \\\n\t{}'.format(samtools_path, out,
+                                             ' \\\n\t'.join(parts)),
+                'rm \\\n\t{}'.format(' \\\n\t'.join(parts)),
+            ]
+            if index:
+                commands.append('{} index -@ {} {} {}'.format(
+                    samtools_path, self.threads - 1, out, out_index))
+            lines = '\n\n'.join(commands)
+        else:
+            lines = '{} merge -@ {} -c -p \\\n\t'.format(samtools_path,
+                                                        self.threads - 1)
+            if index:
+                lines += '--write-index \\\n\t'
+                lines += '{}##idx##{} \\\n\t'.format(out, out_index)
+            else:
+                lines += '{} \\\n\t'.format(out)
+            lines += ' \\\n\t'.join(bams)
+        if bg:
+            lines += ' &\n\n'
+        else:
+            lines += '\n\n'
+        self.add_lines(lines)
+        if index:
+            return out, out_index
+        else:
+            return out
+    
     def picard_index(
         self,
         in_bam, 
@@ -999,19 +1438,14 @@ class JobScript:
     
         """
         index = os.path.join(self.tempdir, os.path.split(in_bam)[1] + '.bai')
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar'.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} BuildBamIndex'.format(picard_path),
+        lines = self._picard_command('BuildBamIndex', picard_path, [
             'I={}'.format(in_bam),
-            'O={}'.format(index)]))
+            'O={}'.format(index)])
         if bg:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return index
     
     def picard_merge(
@@ -1043,43 +1477,42 @@ class JobScript:
             Path to output merged bam file.
     
         """
-        merge_in = ''.join(['\tI={} \\\n'.format(x) for x in bams])
-        lines = ['java -Xmx{}g -jar'.format(int(self.memory * 0.8)),
-                 '\t-XX:ParallelGCThreads=1',
-                 '\t-Djava.io.tmpdir={}'.format(self.tempdir), 
-                 '\t-jar {} MergeSamFiles'.format(picard_path),
-                 '\tASSUME_SORTED=TRUE',
-                 '\tUSE_THREADING=TRUE']
+        args = ['ASSUME_SORTED=TRUE', 'USE_THREADING=TRUE']
         for bam in bams:
-            lines.append('\tI={}'.format(bam))
-        lines.append('\tO={}'.format(out_bam))
-        lines = (' \\\n'.join(lines))
+            args.append('I={}'.format(bam))
+        args.append('O={}'.format(out_bam))
+        lines = self._picard_command('MergeSamFiles', picard_path, args)
         if bg:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out_bam
     
     def samtools_index(
         self,
         in_bam, 
         bg=False,
+        threads=None,
         samtools_path='samtools',
     ):
         """
-        Index bam file using samtools.
+        Index bam file using samtools. BGZF decompression is multithreaded.
     
         Parameters
         ----------
         in_bam : str
             Path to file input bam file.
     
-        index : str
-            Path to index file to be written. If not provided, the index is
-            written to the samtools default {in_bam}.bai in the current working
-            directory.
+        bg : boolean
+            Whether to run the process in the background.
+    
+        threads : int
+            Number of threads to use. Defaults to the number of threads for the
+            job.
+    
+        samtools_path : str
+            Path to samtools executable.
     
         Returns
         -------
@@ -1087,20 +1520,24 @@ class JobScript:
             Path to index file for input bam file.
     
         """
-        index = os.path.join(self.tempdir, os.path.splitext(in_bam)[0] + '.bai')
-        line = '{} index {}'.format(samtools_path, in_bam)
+        if threads is None:
+            threads = self.threads
+        index = os.path.join(self.tempdir, os.path.split(in_bam)[1] + '.bai')
+        lines = '{} index -@ {} \\\n\t{} \\\n\t{}'.format(
+            samtools_path, threads - 1, in_bam, index)
         if bg:
-            line += ' &\n\n'
+            lines += ' &\n\n'
         else:
-            line += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+            lines += '\n\n'
+        self.add_lines(lines)
         return index
 
     def biobambam2_mark_duplicates(
         self,
         in_bam,
         remove_duplicates=False,
+        bg=False,
+        index=False,
         bammarkduplicates_path='bammarkduplicates',
     ):
         """
@@ -1111,6 +1548,13 @@ class JobScript:
         in_bam : str
             Path to input bam file.
     
+        bg : boolean
+            Whether to run the process in the background.
+
+        index : boolean
+            If True, bammarkduplicates indexes the output bam file as it writes
+            it so the bam file doesn't need to be read again by an indexer.
+
         bammarkduplicates_path : str
             Path to bammarkduplicates.
     
@@ -1124,6 +1568,9 @@ class JobScript:
 
         removed_reads : str
             Path to bam file with removed reads if remove_duplicates == True.
+
+        index : str
+            Path to index file for output bam file if index == True.
     
         """
         t = 'mdup'
@@ -1142,13 +1589,20 @@ class JobScript:
                 self.tempdir,
                 '{}_removed_duplicates.bam'.format(self.sample_name))
             lines += ('\\\n\trmdup=1 \\\n\tD={}'.format(removed_reads))
-        lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
-        if remove_duplicates:
-            return mdup_bam, dup_metrics, removed_reads
+        if index:
+            bam_index = mdup_bam + '.bai'
+            lines += ' \\\n\tindex=1 \\\n\tindexfilename={}'.format(bam_index)
+        if bg:
+            lines += ' &\n\n'
         else:
-            return mdup_bam, dup_metrics
+            lines += '\n\n'
+        self.add_lines(lines)
+        out = [mdup_bam, dup_metrics]
+        if remove_duplicates:
+            out.append(removed_reads)
+        if index:
+            out.append(bam_index)
+        return tuple(out)
     
     def picard_mark_duplicates(
         self,
@@ -1177,26 +1631,22 @@ class JobScript:
             Path to index file for input bam file.
     
         """
-        mdup_bam = os.path.join(
-            self.tempdir, '{}_sorted_mdup.bam'.format(self.sample_name))
-        dup_metrics = os.path.join(
-            self.tempdir, '{}_duplicate_metrics.txt'.format(self.sample_name))
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar '.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} MarkDuplicates'.format(picard_path),
+        mdup_bam = self._tmp_sample_prefix + 'sorted_mdup.bam'
+        dup_metrics = self._tmp_sample_prefix + 'duplicate_metrics.txt'
+        # Picard suggests about 250,000 records per Gb of heap. The default
+        # keeps far fewer in memory and spills many more temp files.
+        lines = self._picard_command('MarkDuplicates', picard_path, [
             'METRICS_FILE={}'.format(dup_metrics),
             'VALIDATION_STRINGENCY=SILENT',
             'ASSUME_SORTED=TRUE',
+            'MAX_RECORDS_IN_RAM={}'.format(self._java_memory() * 250000),
             'I={}'.format(in_bam), 
-            'O={}'.format(out_bam)]))
+            'O={}'.format(mdup_bam)])
         if remove_dups:
             lines += ' \\\n\tREMOVE_DUPLICATES=TRUE\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return mdup_bam, dup_metrics
 
     def picard_gc_bias_metrics(
@@ -1233,29 +1683,21 @@ class JobScript:
             Path to picard output file.
     
         """
-        metrics = os.path.join(self.tempdir,
-                               '{}_gc_bias_metrics.txt'.format(self.sample_name))
-        chart = os.path.join(self.tempdir,
-                             '{}_gc_bias.pdf'.format(self.sample_name))
-        out = os.path.join(self.tempdir,
-                           '{}_gc_bias_metrics_out.txt'.format(self.sample_name))
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar '.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} CollectGcBiasMetrics'.format(picard_path),
+        metrics = self._tmp_sample_prefix + 'gc_bias_metrics.txt'
+        chart = self._tmp_sample_prefix + 'gc_bias.pdf'
+        out = self._tmp_sample_prefix + 'gc_bias_metrics_out.txt'
+        lines = self._picard_command('CollectGcBiasMetrics', picard_path, [
             'VALIDATION_STRINGENCY=SILENT',
             'I={}'.format(in_bam), 
             'O={}'.format(out),
             'CHART_OUTPUT={}'.format(chart),
             'SUMMARY_OUTPUT={}'.format(metrics),
-            'ASSUME_SORTED=TRUE']))
+            'ASSUME_SORTED=TRUE'])
         if bg:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return metrics, chart, out
     
     def picard_bam_index_stats(
@@ -1292,21 +1734,16 @@ class JobScript:
                            '{}_index_stats.txt'.format(self.sample_name))
         err = os.path.join(self.outdir,
                            '{}_index_stats.err'.format(self.sample_name))
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar '.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} BamIndexStats'.format(picard_path),
+        lines = self._picard_command('BamIndexStats', picard_path, [
             'VALIDATION_STRINGENCY=SILENT',
             'I={}'.format(in_bam),
             '> {}'.format(out),
-            '2> {}'.format(err)]))
+            '2> {}'.format(err)])
         if bg:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out, err
     
     def picard_insert_size_metrics(
@@ -1340,35 +1777,30 @@ class JobScript:
             Path to output histogram PDF.
     
         """
-        metrics = os.path.join(
-            self.tempdir, '{}_insert_size_metrics.txt'.format(self.sample_name))
-        hist = os.path.join(self.tempdir,
-                            '{}_insert_size.pdf'.format(self.sample_name))
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar '.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} CollectInsertSizeMetrics'.format(picard_path),
+        metrics = self._tmp_sample_prefix + 'insert_size_metrics.txt'
+        hist = self._tmp_sample_prefix + 'insert_size.pdf'
+        lines = self._picard_command('CollectInsertSizeMetrics', picard_path, [
             'VALIDATION_STRINGENCY=SILENT',
             'I={}'.format(in_bam), 
             'O={}'.format(metrics),
             'HISTOGRAM_FILE={}'.format(hist),
-            'ASSUME_SORTED=TRUE']))
+            'ASSUME_SORTED=TRUE'])
         if bg:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return metrics, hist
     
     def picard_query_sort(
+        self,
         in_bam, 
         picard_path='$picard',
         bg=False,
     ):
         """
-        Query sort using Picard Tools.
+        Query sort bam file. This used to use Picard SortSam but now uses
+        samtools_sort which is multi-threaded and much faster.
     
         Parameters
         ----------
@@ -1376,8 +1808,7 @@ class JobScript:
             Path to input bam file.
     
         picard_path : str
-            Path to picard jar file. Default assumes the environmental variable
-            $picard contains the path to the jar file.
+            Not used. Kept so existing calls still work.
     
         bg : boolean
             Whether to run the process in the background.
@@ -1388,24 +1819,91 @@ class JobScript:
             Path to output bam file.
     
         """
-        out_bam = os.path.join(self.tempdir,
-                               '{}_qsorted.bam'.format(self.sample_name))
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar '.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} SortSam'.format(picard_path),
-            'VALIDATION_STRINGENCY=SILENT',
-            'I={}'.format(in_bam), 
-            'O={}'.format(out_bam),
-            'SO=queryname']))
+        return self.samtools_sort(in_bam, queryname=True, bg=bg)
+    
+    def samtools_sort(
+        self,
+        in_bam, 
+        queryname=False,
+        index=False,
+        root=None,
+        mem_per_thread=None,
+        bg=False,
+        samtools_path='samtools',
+    ):
+        """
+        Sort bam file using samtools. Sorting uses all of the job's threads.
+    
+        Parameters
+        ----------
+        in_bam : str
+            Path to input bam file.
+        
+        queryname : bool
+            If True, sort by query name. Otherwise sort by coordinate.
+
+        index : bool
+            If True, index the coordinate sorted bam file as it is written
+            (requires samtools >= 1.10). Query sorted files can't be indexed.
+
+        root : str
+            If provided, use for naming the file [root]_query_sorted.bam or
+            [root]_sorted.bam.
+    
+        mem_per_thread : str
+            Maximum memory to use per thread (samtools sort -m, e.g. 768M). By
+            default the job's threads share 80% of the job's memory. Pass a
+            smaller value if other processes in the job need memory at the same
+            time.
+
+        bg : boolean
+            Whether to run the process in the background.
+    
+        samtools_path : str
+            Path to samtools executable.
+    
+        Returns
+        -------
+        out_bam : str
+            Path to output bam file.
+    
+        out_index : str
+            Path to output index file. Only returned if index == True.
+    
+        """
+        if queryname and index:
+            raise ValueError('Query sorted bam files cannot be indexed.')
+        if mem_per_thread is None:
+            mem_per_thread = self._sort_memory()
+        if not root:
+            root = self.sample_name
+        if queryname:
+            out_bam = os.path.join(
+                self.tempdir, '{}_query_sorted.bam'.format(root))
+        else:
+            out_bam = os.path.join(
+                self.tempdir, '{}_sorted.bam'.format(root))
+        lines = '{} sort -@ {} -m {}'.format(samtools_path, self.threads - 1,
+                                            mem_per_thread)
+        if queryname:
+            lines += ' -n'
+        lines += ' \\\n\t'
+        if index:
+            out_index = out_bam + '.bai'
+            lines += '--write-index \\\n\t'
+            lines += '-o {}##idx##{} \\\n\t'.format(out_bam, out_index)
+        else:
+            lines += '-o {} \\\n\t'.format(out_bam)
+        lines += in_bam
         if bg:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
-        return out_bam
+        self.add_lines(lines)
+        if index:
+            return out_bam, out_index
+        else:
+            return out_bam
     
     def sambamba_sort(
         self,
@@ -1460,8 +1958,7 @@ class JobScript:
         lines += '{} \\\n\t'.format(in_bam)
         lines += '-o {}\n\n'.format(out_bam)
 
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out_bam
     
     def picard_coord_sort(
@@ -1471,16 +1968,19 @@ class JobScript:
         picard_path='$picard',
     ):
         """
-        Coordinate sort using Picard Tools.
+        Coordinate sort bam file. This used to use Picard SortSam but now uses
+        samtools_sort which is multi-threaded and much faster.
     
         Parameters
         ----------
         in_bam : str
             Path to input bam file.
     
+        index : bool
+            If True, index the sorted bam file.
+
         picard_path : str
-            Path to picard jar file. Default assumes the environmental variable
-            $picard contains the path to the jar file.
+            Not used. Kept so existing calls still work.
     
         Returns
         -------
@@ -1491,31 +1991,7 @@ class JobScript:
             Path to output index file. Only returned if index == True.
     
         """
-        out_bam = os.path.join(self.tempdir,
-                               '{}_sorted.bam'.format(self.sample_name))
-        if index:
-            out_index = os.path.join(out_bam + '.bai')
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar '.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} SortSam'.format(picard_path),
-            'VALIDATION_STRINGENCY=SILENT',
-            'I={}'.format(in_bam), 
-            'O={}'.format(out_bam),
-            'SO=coordinate']))
-        if index:
-            lines += ' \\\n\tCREATE_INDEX=TRUE\n\n' 
-            old_index = '.'.join(out_bam.split('.')[0:-1]) + '.bai'
-            lines += 'mv {} {}'.format(old_index, out_index)
-        lines += '\n\n'
-
-        with open(self.filename, "a") as f:
-            f.write(lines)
-        if index:
-            return out_bam, out_index
-        else: 
-            return out_bam
+        return self.samtools_sort(in_bam, index=index)
     
     def picard_reorder(
         self,
@@ -1541,20 +2017,14 @@ class JobScript:
             Path to output bam file.
     
         """
-        out_bam = os.path.join(self.tempdir,
-                               '{}_reordered.bam'.format(self.sample_name))
-        lines = (' \\\n\t'.join([
-            'java -Xmx{}g -jar '.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {} ReorderSam'.format(picard_path),
+        out_bam = self._tmp_sample_prefix + 'reordered.bam'
+        lines = self._picard_command('ReorderSam', picard_path, [
             'VALIDATION_STRINGENCY=SILENT',
             'I={}'.format(in_bam), 
             'O={}'.format(out_bam),
-            'REFERENCE={}'.format(fasta)])) + '\n\n'
+            'REFERENCE={}'.format(fasta)]) + '\n\n'
 
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out_bam
     
     def cutadapt_trim(
@@ -1563,6 +2033,7 @@ class JobScript:
         length, 
         out, 
         bg=False,
+        threads=None,
     ):
         """
         Cut a specified number of bases from a fastq file using cutadapt.
@@ -1585,19 +2056,25 @@ class JobScript:
             Whether to run the process in the background (i.e. include an
             ampersand at the end of the command).
     
+        threads : int
+            Number of cutadapt worker processes. Defaults to the number of
+            threads for the job.
+    
         Returns
         -------
         out : str
             Path to output (optionally gzipped/bzipped) fastq files.
     
         """
-        line = 'cutadapt --cut {} -o {} {}'.format(length, out, fastq)
+        if threads is None:
+            threads = self.threads
+        lines = 'cutadapt -j {} --cut {} -o {} {}'.format(threads, length, out,
+                                                         fastq)
         if bg:
-            line += ' &\n\n'
+            lines += ' &\n\n'
         else:
-            line += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+            lines += '\n\n'
+        self.add_lines(lines)
         return out
     
     def bedgraph_to_bigwig(
@@ -1629,20 +2106,13 @@ class JobScript:
         """
         bigwig = os.path.join(
             self.tempdir,
-            '{}.bw'.format(os.path.splitext(os.path.split(bedgraph)[1])))
-        # If bedtools is in the path, I'll assume the genome file is as well.
-        if bedtools_path == 'bedtools':
-            bedtools_genome_path = 'human.hg19.genome'
-        else:
-            bedtools_genome_path = os.path.join(
-                os.path.split(os.path.split(bedtools_path)[0])[0], 'genomes',
-                'human.hg19.genome')
+            os.path.splitext(os.path.basename(bedgraph))[0] + '.bw')
+        bedtools_genome_path = _bedtools_genome_file(bedtools_path)
         lines =  ' \\\n\t'.join([
             '{} {}'.format(bedgraph_to_bigwig_path, bedgraph),
             '{}'.format(bedtools_genome_path),
             '{} &\n'.format(bigwig)])
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return bigwig
     
     def flagstat(
@@ -1650,6 +2120,7 @@ class JobScript:
         bam, 
         samtools_path='samtools',
         bg=False,
+        threads=None,
     ):
         """
         Run flagstat for a bam file.
@@ -1662,22 +2133,28 @@ class JobScript:
         samtools_path : str
             Path to samtools executable.
     
+        threads : int
+            Number of threads to use. Defaults to the number of threads for the
+            job.
+    
         Returns
+        -------
         stats_file : str
             File to write flagstats to.
     
-        -------
         """
+        if threads is None:
+            threads = self.threads
         stats_file = os.path.join(
             self.tempdir, '{}_flagstat.txt'.format(
                 os.path.splitext(os.path.split(bam)[1])[0]))
-        lines = '{} flagstat {} > {}'.format(samtools_path, bam, stats_file)
+        lines = '{} flagstat -@ {} {} > {}'.format(samtools_path, threads - 1,
+                                                   bam, stats_file)
         if bg:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return stats_file
     
     def combine_fastqs(
@@ -1692,8 +2169,9 @@ class JobScript:
 
         Parameters
         ----------
-        fastqs : list
-            List of paths to gzipped fastq files.
+        fastqs : list or str
+            List of paths to gzipped fastq files or path to a single gzipped
+            fastq file.
     
         suffix : str
             Add this to the combined file name (for instance, R1 or R2).
@@ -1708,8 +2186,14 @@ class JobScript:
         if suffix:
             root += '_' + suffix
         out_fastq = os.path.join(self.tempdir, root + '.fastq.gz')
-        fastqs = sorted(fastqs)
+        if isinstance(fastqs, basestring):
+            fastqs = [fastqs]
+        elif len(fastqs) > 1:
+            fastqs = sorted(fastqs)
         if len(fastqs) > 1:
+            # Concatenated gzip files are a valid gzip file so we don't need to
+            # decompress and recompress. Recompressing with pigz wouldn't help
+            # downstream tools since gzip decompression can't be parallelized.
             lines = 'cat \\\n\t{} \\\n\t> {}'.format(' \\\n\t'.join(fastqs),
                                                      out_fastq)
         else:
@@ -1718,8 +2202,7 @@ class JobScript:
             lines += ' &\n\n'
         else:
             lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return out_fastq
     
     def fastqc(
@@ -1764,27 +2247,29 @@ class JobScript:
         fastqc_html = []
         fastqc_zip = []
         for fq in fastqs:
-            fastqc_html.append(
-                os.path.join(dy, '{}_fastqc.html'.format(
-                    '.'.join(os.path.split(fq)[1].split('.')[0:-2]))))
-            fastqc_zip.append(
-                os.path.join(dy, '{}_fastqc.zip'.format(
-                    '.'.join(os.path.split(fq)[1].split('.')[0:-2]))))
+            # FastQC names its output after the fastq without the compression
+            # and fastq extensions.
+            root = os.path.basename(fq)
+            for ext in ['.gz', '.bz2', '.fastq', '.fq']:
+                if root.endswith(ext):
+                    root = root[:-len(ext)]
+            fastqc_html.append(os.path.join(dy, root + '_fastqc.html'))
+            fastqc_zip.append(os.path.join(dy, root + '_fastqc.zip'))
         fastqs = ' \\\n\t'.join(fastqs)
 
         lines = ('{} --outdir {} --nogroup --threads {} \\\n'
                  '\t{}\n'.format(fastqc_path, dy, self.threads, fastqs))
         
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
 
         if web_available:
-            if self.linkdir:
-                for html in fastqc_html:
-                    link = self.add_softlink(html)
-            url = self.webpath + '/' + os.path.split(html)[1]
+            urls = []
+            for html in fastqc_html:
+                if self.linkdir:
+                    html = self.add_softlink(html)
+                urls.append(self.webpath + '/' + os.path.basename(html) + '\n')
             with open(self.links_tracklines, "a") as f:
-                f.write(url + '\n')
+                f.write(''.join(urls))
 
         return fastqc_html, fastqc_zip
     
@@ -1799,6 +2284,8 @@ class JobScript:
         vcf_chrom_conv=None,
         samtools_path='samtools',
         bcftools_path='bcftools',
+        bedtools_path='bedtools',
+        threads=None,
     ):
         """
         Swap alleles for reads that overlap heterozygous variants.
@@ -1839,6 +2326,19 @@ class JobScript:
             Sample name of this sample in the VCF file (if different than
             sample_name).
 
+        samtools_path : str
+            Path to samtools executable.
+
+        bcftools_path : str
+            Path to bcftools executable.
+
+        bedtools_path : str
+            Path to bedtools executable.
+
+        threads : int
+            Number of threads to use for samtools. Defaults to the number of
+            threads for the job.
+
         Returns
         -------
         snp_directory : str
@@ -1865,7 +2365,9 @@ class JobScript:
             done per read pair.
         """
         if not vcf_sample_name:
-            vcf_sample_name = sample_name
+            vcf_sample_name = self.sample_name
+        if threads is None:
+            threads = self.threads
 
         # Files that will be created.
         uniq_bam = os.path.join(
@@ -1894,20 +2396,28 @@ class JobScript:
             '-v ' + ' \\\n\t-v '.join(vcfs),
             '-g {}'.format(gatk_fai),
             '-b {}'.format(bcftools_path),
+            '-d {}'.format(bedtools_path),
             '-t {}'.format(self.tempdir),
+            '-p {}'.format(threads),
         ]) 
         if vcf_chrom_conv:
             lines += ' \\\n\t-c {}'.format(vcf_chrom_conv)
         lines += '\n\n'
-        lines += ('{} view -b -q 255 -F 1024 \\\n\t{} '
-                  '\\\n\t> {}\n\n'.format(
-                    samtools_path, bam, uniq_bam))
-        lines += 'wait\n\n'
+        # WASP names its output files after the input bam file so we can't
+        # give it the reads on stdin. Instead, uniq_bam is a named pipe that
+        # samtools writes uncompressed bam to. This avoids writing the bam to
+        # disk and compressing and decompressing it again.
+        lines += 'mkfifo {}\n\n'.format(uniq_bam)
+        lines += ('{} view -@ {} -u -q 255 -F 1024 \\\n\t{} '
+                  '\\\n\t> {} &\n\n'.format(
+                    samtools_path, threads - 1, bam, uniq_bam))
+        lines += 'samtools_pid=$!\n\n'
         # Run WASP to swap alleles.
-        lines += ('python {} -s -p \\\n\t{} \\\n\t{}\n\n'.format(
+        lines += ('python {} -s -p \\\n\t{} \\\n\t{} &\n\n'.format(
             find_intersecting_snps_path, uniq_bam, snp_directory))
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        lines += 'wasp_pid=$!\n\n'
+        self.add_lines(lines)
+        self.wait_for_background(['samtools_pid', 'wasp_pid'], [uniq_bam])
         return (snp_directory, vcf_out, keep_bam, wasp_r1_fastq, wasp_r2_fastq,
                 to_remap_bam, to_remap_num)
 
@@ -1942,31 +2452,49 @@ class JobScript:
         Returns
         -------
         wasp_filtered_bam : str
-            Path to bam file after filtering against re-mapped reads.
+            Path to coordinate sorted bam file after filtering against
+            re-mapped reads.
+    
+        wasp_bam_index : str
+            Path to index for wasp_filtered_bam.
     
         """
-        # Files that will be created.
-        wasp_filtered_bam = os.path.join(
+        # WASP writes the filtered reads to a named pipe that samtools sorts
+        # from so the unsorted bam is never written to disk.
+        temp_filtered_bam = os.path.join(
             self.tempdir, '{}_filtered.bam'.format(self.sample_name))
+        lines = 'mkfifo {}\n\n'.format(temp_filtered_bam)
         
         # Run WASP alignment compare.
-        lines = ('python {} -p \\\n\t{} \\\n\t{} \\\n\t{} '
-                 '\\\n\t{}\n\n'.format(
-                     filter_remapped_reads_path, to_remap_bam,
-                     remapped_bam, wasp_filtered_bam, to_remap_num))
-        with open(self.filename, "a") as f:
-            f.write(lines)
-        return wasp_filtered_bam
+        lines += ('python {} -p \\\n\t{} \\\n\t{} \\\n\t{} '
+                  '\\\n\t{} &\n\n'.format(
+                      filter_remapped_reads_path, to_remap_bam,
+                      remapped_bam, temp_filtered_bam, to_remap_num))
+        lines += 'filter_pid=$!\n\n'
+        self.add_lines(lines)
+
+        # Coordinate sort and index filtered bam file.
+        # filter_remapped_reads.py runs at the same time so samtools only
+        # gets 40% of the job's memory.
+        wasp_filtered_bam, wasp_bam_index = self.samtools_sort(
+            temp_filtered_bam, index=True, bg=True,
+            mem_per_thread=self._sort_memory(0.4))
+        self.add_lines('sort_pid=$!\n\n')
+        self.wait_for_background(['filter_pid', 'sort_pid'],
+                                 [temp_filtered_bam])
+        return wasp_filtered_bam, wasp_bam_index
         
     def count_allele_coverage(
         self,
         bam, 
         vcf,
         fasta, 
+        use_bcftools=False,
         gatk_path='$GATK',
+        bcftools_path='bcftools',
     ):
         """
-        Count alleles using GATK's ASEReadCounter.
+        Count alleles using GATK's ASEReadCounter or bcftools mpileup.
 
         Parameters
         ----------
@@ -1979,6 +2507,18 @@ class JobScript:
         fasta : str
             Path to fasta file used to align data.
 
+        use_bcftools : boolean
+            If True, count alleles with bcftools mpileup instead of GATK. The
+            output has the contig through totalCount columns of ASEReadCounter's
+            output. Indels are skipped so there is one row per site and
+            anomalous read pairs (e.g. pairs that aren't properly paired) are
+            counted as ASEReadCounter does. Overlapping mates are counted once,
+            but where their bases disagree mpileup keeps one mate's base instead
+            of dropping the fragment as ASEReadCounter's
+            COUNT_FRAGMENTS_REQUIRE_SAME_BASE does, so the counts can differ
+            from GATK's. The bam file doesn't need to be sorted in the same
+            order as fasta.
+
         Returns
         -------
         Path to output counts file.
@@ -1988,11 +2528,22 @@ class JobScript:
         # Count allele coverage.
         counts = os.path.join(
             self.tempdir, '{}_allele_counts.tsv'.format(self.sample_name))
-        lines = ' \\\n\t'.join([
-            'java -Xmx{}g -jar'.format(int(self.memory * 0.8)),
-            '-XX:ParallelGCThreads=1',
-            '-Djava.io.tmpdir={}'.format(self.tempdir), 
-            '-jar {}'.format(gatk_path),
+        if use_bcftools:
+            sites = os.path.join(
+                self.tempdir, '{}_het_sites.tsv'.format(self.sample_name))
+            lines = ('{} query -f \'%CHROM\\t%POS\\t%ID\\t%REF\\t%ALT\\n\' '
+                     '\\\n\t{} \\\n\t> {}\n\n'.format(
+                         bcftools_path, vcf, sites))
+            lines += ('{0} mpileup -A -B -I -Q 2 -d 1000000 -a AD -Ou \\\n\t'
+                      '-T {1} \\\n\t-f {2} \\\n\t{3} \\\n\t'
+                      '| {0} query -f \'%CHROM\\t%POS\\t%ALT\\t[%AD]\\n\' '
+                      '\\\n\t| awk \'{4}\' \\\n\t{5} - \\\n\t> {6}\n\n'.format(
+                          bcftools_path, vcf, fasta, bam,
+                          _ALLELE_COUNTS_AWK, sites, counts))
+            lines += 'rm {}\n\n'.format(sites)
+            self.add_lines(lines)
+            return counts
+        lines = self._java_jar_command(gatk_path, [
             '-R {}'.format(fasta),
             '-T ASEReadCounter',
             '-o {}'.format(counts),
@@ -2002,8 +2553,7 @@ class JobScript:
             '-U ALLOW_N_CIGAR_READS',
         ])
         lines += '\n\nwait\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return counts
 
     def mbased(
@@ -2096,8 +2646,7 @@ class JobScript:
                                  snv_outfile, self.sample_name, is_phased,
                                  str(num_sim), str(self.threads)])
         lines += '\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return mbased_infile, locus_outfile, snv_outfile
 # 
 # def merge_bams(
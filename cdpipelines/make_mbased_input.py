@@ -155,6 +155,28 @@ def _mappability_filter(counts, mappability, bigWigAverageOverBed_path):
         removed.
 
     """
+    # If pyBigWig is available, we can look up the mappability for all SNVs
+    # without writing them to a bed file and starting bigWigAverageOverBed.
+    try:
+        import pyBigWig
+    except ImportError:
+        pyBigWig = None
+    if pyBigWig is not None:
+        import numpy as np
+        bw = pyBigWig.open(mappability)
+        chroms = bw.chroms()
+        unique = np.zeros(counts.shape[0], dtype=bool)
+        for c in set(counts.contig):
+            if c not in chroms:
+                continue
+            ind = np.where(counts.contig.values == c)[0]
+            # Positions without a value are NaN so they aren't kept.
+            vals = np.array([bw.values(c, p - 1, p)[0] for p in
+                             counts.position.values[ind]])
+            unique[ind] = vals == 1
+        bw.close()
+        return counts[unique]
+
     import subprocess
     import tempfile
     tempfile.NamedTemporaryFile()
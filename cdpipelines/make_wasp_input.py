@@ -4,6 +4,11 @@ import subprocess
 
 import cdpipelines as ps
 
+def _check_call_all(commands):
+    """Run shell commands one after another."""
+    for c in commands:
+        subprocess.check_call(c, shell=True)
+
 def _wasp_snp_directory(
     vcfs, 
     directory, 
@@ -14,6 +19,8 @@ def _wasp_snp_directory(
     vcf_chrom_conv=None,
     tempdir='.', 
     bcftools_path='bcftools',
+    bedtools_path='bedtools',
+    threads=1,
 ):
     """
     Convert VCF files into input files directory and files needed for WASP. Only
@@ -53,14 +60,27 @@ def _wasp_snp_directory(
     tempdir : str
         Path to temporary directory. 
 
+    bedtools_path : str
+        Path to bedtools executable.
+
+    threads : int
+        Number of threads to use for sorting the regions, extracting the
+        variants for different chromosomes at once, and compressing the WASP
+        SNP files.
+
     """
+    from distutils.spawn import find_executable
     import glob
-    import pybedtools as pbt
+    from multiprocessing.pool import ThreadPool
+    import tempfile
     import vcf as pyvcf
     
     # Collapse bed file.
-    bt = pbt.BedTool(regions)
-    bt = bt.merge()
+    fd, merged_regions = tempfile.mkstemp(suffix='.bed', dir=tempdir)
+    os.close(fd)
+    c = ('sort --parallel={} -S 2G -k1,1 -k2,2n {} | {} merge -i - > '
+         '{}'.format(threads, regions, bedtools_path, merged_regions))
+    subprocess.check_call(c, shell=True)
     # If a vcf_chrom_conv file is provided, we should check to see which
     # chromosome naming scheme was used for this bed file. If it's not the
     # correct naming scheme for the VCF, we'll convert.
@@ -68,7 +88,8 @@ def _wasp_snp_directory(
         import pandas as pd
         conv = pd.read_table(vcf_chrom_conv, header=None, index_col=1,
                              squeeze=True)
-        df = bt.to_dataframe()
+        df = pd.read_table(merged_regions, header=None,
+                           names=['chrom', 'start', 'end'])
         # Check to see whether any chromosomes have RNA-seq naming convention.
         # If so, we'll assume the bed file is in the RNA-seq naming convention.
         # Any chromosomes not in our conversion index will be dropped from the
@@ -76,45 +97,80 @@ def _wasp_snp_directory(
         if len(set(df.chrom) & set(conv.index)) > 0:
             df = df[df.chrom.apply(lambda x: x in conv.index)]
             df['chrom'] = df.chrom.apply(lambda x: conv[x])
-            df = df.astype(str)
-            s = '\n'.join(df.apply(lambda x: '\t'.join(x), axis=1)) + '\n'
-            bt = pbt.BedTool(s, from_string=True)
+            df.to_csv(merged_regions, sep='\t', header=False, index=False)
 
     # Extract all heterozygous variants for this sample. We'll write the files
     # needed for WASP as well as a VCF with just the hets for this sample.
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    temp_vcfs = []
+    # mawk is much faster than other awks for simple line-by-line work like
+    # splitting the variants up by chromosome.
+    awk = 'mawk' if find_executable('mawk') else 'awk'
+
+    # I'll check to see whether the sample is in each VCF. This might be
+    # useful for sex chromosome calls that are split up by sex etc.
+    sample_vcfs = []
     for vcf in vcfs:
-        # I'll check to see whether the sample is in the VCF. This might be
-        # useful for sex chromosome calls that are split up by sex etc.
-        if vcf[-3:]:
-            vcf_reader = pyvcf.Reader(open(vcf), compressed=True)
-        else:
-            vcf_reader = pyvcf.Reader(open(vcf))
+        vcf_reader = pyvcf.Reader(open(vcf), compressed=vcf.endswith('.gz'))
         if vcf_sample_name in vcf_reader.samples:
+            sample_vcfs.append(vcf)
+
+    # Split the regions up by chromosome so the variants for each chromosome
+    # can be extracted at the same time. Most of the time goes to parsing all
+    # of the samples' genotypes, which bcftools does on one thread. Each
+    # chromosome's WASP SNP file is only written by the process for that
+    # chromosome.
+    chroms = []
+    chrom_lines = {}
+    with open(merged_regions) as f:
+        for line in f:
+            chrom = line.split('\t')[0]
+            if chrom not in chrom_lines:
+                chroms.append(chrom)
+                chrom_lines[chrom] = []
+            chrom_lines[chrom].append(line)
+    os.remove(merged_regions)
+    chrom_regions = {}
+    for chrom in chroms:
+        fd, chrom_regions[chrom] = tempfile.mkstemp(suffix='.bed', dir=tempdir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(''.join(chrom_lines[chrom]))
+
+    # The temp VCFs are concatenated in the order the VCFs were given and then
+    # by chromosome within each VCF.
+    temp_vcfs = dict([(vcf, []) for vcf in sample_vcfs])
+    commands = []
+    for chrom in chroms:
+        chrom_commands = []
+        for vcf in sample_vcfs:
             root = os.path.splitext(os.path.split(vcf)[1])[0]
-            tvcf = os.path.join(tempdir, '{}_hets.tsv'.format(root))
-            temp_vcfs.append(tvcf)
+            tvcf = os.path.join(tempdir, '{}_{}_hets.tsv'.format(root, chrom))
+            temp_vcfs[vcf].append(tvcf)
             c = ('{} view -O u -m2 -M2 \\\n\t-R {} \\\n\t-s {} \\\n\t{} \\\n\t'
                  '| {} view -g het '.format(
-                     bcftools_path, bt.fn, vcf_sample_name, vcf, bcftools_path))
+                     bcftools_path, chrom_regions[chrom], vcf_sample_name, vcf,
+                     bcftools_path))
             if vcf_chrom_conv:
                 c += '-Ou \\\n\t| {} annotate --rename-chrs {} '.format(
                     bcftools_path, vcf_chrom_conv)
                  
-            c += ('\\\n\t| tee {} \\\n\t| grep -v ^\\# \\\n\t| cut -f1,2,4,5 '
-                  '\\\n\t| awk \'{{print $2"\\t"$3"\\t"$4 >> '
+            c += ('\\\n\t| tee {} \\\n\t| {} query '
+                  '-f \'%CHROM\\t%POS\\t%REF\\t%ALT\\n\' - '
+                  '\\\n\t| {} \'{{print $2"\\t"$3"\\t"$4 >> '
                   '("{}/"$1".snps.txt")}}\''.format(
-                     tvcf, directory))
-            subprocess.check_call(c, shell=True)
-        else:
-            vcfs.remove(vcf)
+                     tvcf, bcftools_path, awk, directory))
+            chrom_commands.append(c)
+        commands.append(chrom_commands)
+    pool = ThreadPool(max(threads, 1))
+    pool.map(_check_call_all, commands)
+    pool.close()
+    [os.remove(x) for x in chrom_regions.values()]
+    temp_vcfs = sum([temp_vcfs[vcf] for vcf in sample_vcfs], [])
 
-    # If multiple VCFs, concatenate the temp VCFs to make the final VCF.
+    # If multiple temp VCFs, concatenate them to make the final VCF.
     # Otherwise, just rename the single temp VCF.
-    if len(vcfs) > 1:
+    if len(temp_vcfs) > 1:
         c = '{} concat {} > {}'.format(bcftools_path, ' '.join(temp_vcfs),
                                                                vcf_out)
         subprocess.check_call(c, shell=True)
@@ -122,34 +178,31 @@ def _wasp_snp_directory(
     else:
         os.rename(temp_vcfs[0], vcf_out)
 
-    # Now we gzip the files.
+    # Now we gzip the files. bgzip (from htslib, like bcftools) and pigz
+    # compress in parallel and their output can be read like any gzip file;
+    # otherwise we at least only start gzip once.
     fns = glob.glob(os.path.join(directory, '*.snps.txt'))
-    for fn in fns:
-        subprocess.check_call('gzip {}'.format(fn), shell=True)
+    if len(fns) > 0:
+        if find_executable('bgzip'):
+            for fn in fns:
+                subprocess.check_call(['bgzip', '--threads', str(threads), '-f',
+                                       fn])
+        elif find_executable('pigz'):
+            subprocess.check_call(['pigz', '-p', str(threads)] + fns)
+        else:
+            subprocess.check_call(['gzip'] + fns)
 
     # If a gatk_fai file is provided, we need to reorder the VCF to match
-    # the fai.
+    # the fai. bcftools sort orders variants by the contig lines in the
+    # header, so we first replace the contig lines with those from the fai.
     if gatk_fai:
-        vcf_sorted = os.path.join(tempdir,
-                                  '{}_sorted.vcf'.format(vcf_sample_name))
-        from __init__ import _scripts
-        sortByRef_path = os.path.join(_scripts, 'sortByRef.pl')
-        c = 'perl {} {} {} > {}'.format(sortByRef_path, vcf_out, gatk_fai,
-                                           vcf_sorted)
-        subprocess.check_call(c, shell=True)
-        vcf_header = os.path.join(tempdir,
-                                  '{}_header.vcf'.format(vcf_sample_name))
-        c = 'grep ^\\# {} > {}'.format(vcf_sorted, vcf_header)
-        subprocess.check_call(c, shell=True)
-        vcf_body = os.path.join(tempdir,
-                                  '{}_body.vcf'.format(vcf_sample_name))
-        c = 'grep -v ^\\# {} > {}'.format(vcf_sorted, vcf_body)
-        subprocess.check_call(c, shell=True)
-        c = 'cat {} {} > {}'.format(vcf_header, vcf_body, vcf_out)
-        subprocess.check_call(c, shell=True)
-        os.remove(vcf_sorted)
-        os.remove(vcf_header)
-        os.remove(vcf_body)
+        vcf_reheader = os.path.join(tempdir,
+                                    '{}_reheader.vcf'.format(vcf_sample_name))
+        subprocess.check_call([bcftools_path, 'reheader', '--fai', gatk_fai,
+                               '-o', vcf_reheader, vcf_out])
+        subprocess.check_call([bcftools_path, 'sort', '-T', tempdir, '-O', 'v',
+                               '-o', vcf_out, vcf_reheader])
+        os.remove(vcf_reheader)
 
 def main():
     parser = argparse.ArgumentParser(description=(
@@ -190,6 +243,13 @@ def main():
     parser.add_argument('-b', metavar='bcftools_path', help=(
         'Path to bcftools executable. By default, assumed to be in your path.'),
         default='bcftools')
+    parser.add_argument('-d', metavar='bedtools_path', help=(
+        'Path to bedtools executable. By default, assumed to be in your path.'),
+        default='bedtools')
+    parser.add_argument('-p', metavar='threads', type=int, help=(
+        'Number of threads to use for sorting the regions, extracting the '
+        'variants for different chromosomes at once, and compressing the WASP '
+        'SNP files.'), default=1)
         
     args = parser.parse_args()
     vcfs = args.v
@@ -201,6 +261,8 @@ def main():
     chrom_conv = args.c
     tempdir = args.t
     bcftools_path = args.b
+    bedtools_path = args.d
+    threads = args.p
 
     _wasp_snp_directory(
         vcfs, 
@@ -212,6 +274,8 @@ def main():
         vcf_chrom_conv=chrom_conv,
         tempdir=tempdir,
         bcftools_path=bcftools_path,
+        bedtools_path=bedtools_path,
+        threads=threads,
     )
 
 if __name__ == '__main__':
@@ -1,8 +1,37 @@
 import os
 
+from general import _bedtools_genome_file
 from general import _make_dir
 from general import JobScript
 
+# sambamba view filters for the reads used to calculate coverage. The library
+# is assumed to be reverse stranded (R1 is on the opposite strand of the
+# transcript).
+_STRAND_FILTERS = {
+    '+': ('((first_of_pair and mate_is_reverse_strand) or '
+          '(second_of_pair and reverse_strand))'),
+    '-': ('((second_of_pair and mate_is_reverse_strand) or '
+          '(first_of_pair and reverse_strand))'),
+    None: 'not (unmapped or mate_is_unmapped)',
+}
+
+# Cached result of _dexseq_count_path(). The DEXSeq installation doesn't
+# change while we're making scripts so we only need to ask R once per process.
+_DEXSEQ_COUNT_PATH = None
+
+def _dexseq_count_path():
+    """Get the path to the dexseq_count.py script installed with DEXSeq."""
+    global _DEXSEQ_COUNT_PATH
+    if _DEXSEQ_COUNT_PATH is not None:
+        return _DEXSEQ_COUNT_PATH
+    # system.file just looks up the installed package's directory so we don't
+    # need to load DEXSeq (which takes a while) or start R inside Python.
+    import subprocess
+    _DEXSEQ_COUNT_PATH = subprocess.check_output(
+        ['Rscript', '-e', 'cat(system.file("python_scripts", '
+         '"dexseq_count.py", package="DEXSeq"))']).strip()
+    return _DEXSEQ_COUNT_PATH
+
 class RNAJobScript(JobScript):
     def star_align(
         self,
@@ -14,7 +43,10 @@ class RNAJobScript(JobScript):
         threads,
         genome_load='LoadAndRemove',
         transcriptome_align=True,
+        read_files_command='zcat',
+        stream_bam=False,
         star_path='STAR',
+        bg=False,
     ):
         """
         Align paired fastq files with STAR.
@@ -33,6 +65,21 @@ class RNAJobScript(JobScript):
         rgpu : str
             Read Group platform unit (eg. run barcode). 
 
+        read_files_command : str
+            Command STAR uses to decompress each fastq file (e.g. zcat or
+            pigz -dc).
+
+        stream_bam : boolean
+            If True, STAR writes the unsorted alignments to stdout and they
+            are redirected to bam. The caller should
+            make bam a named pipe and start the process that reads it in the
+            background beforehand.
+
+        bg : boolean
+            Whether to run STAR and the commands that clean up after it in the
+            background. The background process fails if STAR fails so its
+            status can be checked with wait_for_background.
+
         Returns
         -------
         bam : str
@@ -55,12 +102,17 @@ class RNAJobScript(JobScript):
             only if transcriptome_align == True.
     
         """
+        # STAR's output files are prefixed with the sample name so that STAR
+        # jobs sharing a loaded genome and directory can't write over each
+        # other's files.
+        prefix = os.path.join(self.tempdir, '{}_'.format(self.sample_name))
         lines = (' \\\n\t'.join([
             star_path, 
             '--runThreadN {}'.format(threads),
             '--genomeDir {}'.format(star_index), 
             '--genomeLoad {}'.format(genome_load),
-            '--readFilesCommand zcat',
+            '--outFileNamePrefix {}'.format(prefix),
+            '--readFilesCommand {}'.format(read_files_command),
             '--readFilesIn {} {}'.format(r1_fastq, r2_fastq),
             '--outSAMattributes All', 
             '--outSAMunmapped Within',
@@ -74,10 +126,16 @@ class RNAJobScript(JobScript):
             '--outSAMtype BAM Unsorted']))
         if transcriptome_align:
             lines +=  ' \\\n\t--quantMode TranscriptomeSAM'
-        lines += '\n\n'
-        lines += 'if [ -d _STARtmp ] ; then rm -r _STARtmp ; fi\n\n'
         bam = os.path.join(
             self.tempdir, '{}.bam'.format(self.sample_name))
+        if stream_bam:
+            lines += ' \\\n\t--outStd BAM_Unsorted \\\n\t> {}'.format(bam)
+        if bg:
+            lines = '(\n' + lines + ' || exit 1\n\n'
+        else:
+            lines += '\n\n'
+        lines += ('if [ -d {0}_STARtmp ] ; then rm -r {0}_STARtmp ; '
+                  'fi\n\n'.format(prefix))
         log_out = os.path.join(
             self.tempdir, '{}_Log.out'.format(self.sample_name))
         log_final_out = os.path.join(
@@ -88,30 +146,56 @@ class RNAJobScript(JobScript):
             self.tempdir, '{}_SJ.out.tab'.format(self.sample_name))
         transcriptome_bam = os.path.join(
             self.tempdir, '{}_transcriptome.bam'.format(self.sample_name))
-        lines += 'mv Aligned.out.bam {}\n'.format(bam)
-        lines += 'mv Log.out {}\n'.format(log_out)
-        lines += 'mv Log.final.out {}\n'.format(log_final_out)
-        lines += 'mv Log.progress.out {}\n'.format(log_progress_out)
-        lines += 'mv SJ.out.tab {}\n'.format(sj_out)
+        if not stream_bam:
+            lines += 'mv {}Aligned.out.bam {}\n'.format(prefix, bam)
         if transcriptome_align:
-            lines += 'mv Aligned.toTranscriptome.out.bam {}\n'.format(
-                transcriptome_bam)
+            lines += 'mv {}Aligned.toTranscriptome.out.bam {}\n'.format(
+                prefix, transcriptome_bam)
+        if bg:
+            lines += ') &\n'
         lines += '\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         if transcriptome_align:
             return (bam, log_out, log_final_out, log_progress_out, sj_out,
                     transcriptome_bam)
         else:
             return bam, log_out, log_final_out, log_progress_out, sj_out
 
+    def star_remove_genome(
+        self,
+        star_index,
+        star_path='STAR',
+    ):
+        """
+        Remove a STAR genome that was loaded into shared memory with
+        genomeLoad LoadAndKeep.
+    
+        Parameters
+        ----------
+        star_index : str
+            Path to STAR index.
+    
+        star_path : str
+            Path to STAR aligner.
+    
+        """
+        lines = (' \\\n\t'.join([
+            star_path, 
+            '--genomeDir {}'.format(star_index), 
+            '--genomeLoad Remove',
+            '--outSAMmode None']))
+        lines += '\n\n'
+        lines += ('rm -f Log.out Log.final.out Log.progress.out '
+                  'Aligned.out.sam\n\n')
+        self.add_lines(lines)
+
     def rsem_calculate_expression(
         self,
         bam, 
         reference, 
-        threads=1, 
+        threads=None, 
         calc_ci=False,
-        ci_mem=1024, 
+        ci_mem=None, 
         strand_specific=True,
         rsem_calculate_expression_path='rsem-calculate-expression',
     ):
@@ -126,12 +210,17 @@ class RNAJobScript(JobScript):
         reference : str
             RSEM reference.
 
+        threads : int
+            Number of threads to use. Defaults to the number of threads for the
+            job.
+
         calc_ci : bool
             Whether to calculate confidence intervals.
     
         ci_mem : int
             Amount of memory in mb to give RSEM for calculating confidence
-            intervals. Passed to --ci-memory for RSEM.
+            intervals. Passed to --ci-memory for RSEM. Defaults to half of the
+            job's memory (at least 1024).
     
         strand_specific : boolean
             True if the data is strand-specific. False otherwise. For now, this
@@ -154,24 +243,75 @@ class RNAJobScript(JobScript):
         isoforms = os.path.join(self.tempdir,
                                 '{}.isoforms.results'.format(self.sample_name))
         stats = os.path.join(self.tempdir, '{}.stat'.format(self.sample_name))
-        line = ('{} --bam --paired-end --num-threads {} '
-                '--no-bam-output --seed 3272015 --calc-ci '
-                '--ci-memory {} --estimate-rspd \\\n\t{} \\\n\t{} {}'.format(
-                    rsem_calculate_expression_path, threads, ci_mem, bam,
-                    reference, self.sample_name))
+        if threads is None:
+            threads = self.threads
+        if ci_mem is None:
+            ci_mem = max(1024, int(self.memory * 1024 * 0.5))
         lines = ('{} --bam --paired-end --num-threads {} \\\n\t--no-bam-output '
                  '--seed 3272015 --estimate-rspd \\\n\t'.format(
                      rsem_calculate_expression_path, threads))
         if calc_ci:
-                lines += '--calc-ci --ci-memory {} \\\n\t'.format(ci_mem)
+            lines += '--calc-ci --ci-memory {} \\\n\t'.format(ci_mem)
         if strand_specific:
             lines += '--forward-prob 0 \\\n\t'
         lines += '{} \\\n\t{} \\\n\t{}\n\n'.format(bam, reference,
                                                    self.sample_name)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return genes, isoforms, stats
 
+    def salmon_quant(
+        self,
+        bam, 
+        transcripts, 
+        strand_specific=True,
+        salmon_path='salmon',
+    ):
+        """
+        Estimate transcript expression from a transcriptome alignment bam file
+        using salmon's alignment-based mode. This uses all of the job's
+        threads.
+    
+        Parameters
+        ----------
+        bam : str
+            Transcriptome bam file.
+    
+        transcripts : str
+            Fasta file with the transcript sequences used to make the STAR
+            transcriptome alignments.
+
+        strand_specific : boolean
+            True if the data is strand-specific. False otherwise. For now, this
+            means that the R1 read is on the reverse strand.
+    
+        salmon_path : str
+            Path to salmon executable.
+
+        Returns
+        -------
+        out_dir : str
+            Path to salmon output directory. Transcript estimates are in
+            quant.sf in this directory.
+
+        """
+        out_dir = os.path.join(self.tempdir,
+                               '{}_salmon'.format(self.sample_name))
+        if strand_specific:
+            lib_type = 'ISR'
+        else:
+            lib_type = 'IU'
+        lines = (' \\\n\t'.join([
+            '{} quant'.format(salmon_path),
+            '-l {}'.format(lib_type),
+            '-p {}'.format(self.threads),
+            '--seqBias --gcBias',
+            '-t {}'.format(transcripts),
+            '-a {}'.format(bam),
+            '-o {}'.format(out_dir)]))
+        lines += '\n\n'
+        self.add_lines(lines)
+        return out_dir
+
     def dexseq_count(
         self,
         bam, 
@@ -180,6 +320,8 @@ class RNAJobScript(JobScript):
         strand_specific=True, 
         dexseq_count_path=None,
         samtools_path='samtools',
+        use_featureCounts=False,
+        featureCounts_path='featureCounts',
     ):
         """
         Count reads overlapping exonic bins for DEXSeq.
@@ -199,8 +341,13 @@ class RNAJobScript(JobScript):
             True if the data is strand-specific. False otherwise.
 
         dexseq_count_path : str
-            Path to dexseq_count.py script. If not provided, rpy2 will look for
-            the path in R.
+            Path to dexseq_count.py script. If not provided, Rscript will look
+            for the path in the DEXSeq installation.
+
+        use_featureCounts : boolean
+            If True, count the bins with featureCounts using all of the job's
+            threads instead of dexseq_count.py. The output has the same
+            gene_id:exonic_part_number format that DEXSeq reads.
     
         Returns
         -------
@@ -210,14 +357,38 @@ class RNAJobScript(JobScript):
         """
         counts_file = os.path.join(
             self.tempdir, '{}_dexseq_counts.tsv'.format(self.sample_name))
+        if use_featureCounts:
+            # featureCounts counts properly paired fragments (-B -C) for each
+            # exonic part (-f) and counts fragments that overlap several parts
+            # for each of them (-O) like dexseq_count.py does. The exonic part
+            # number is added as a column so we can make the bin IDs.
+            fc_out = os.path.join(
+                self.tempdir,
+                '{}_dexseq_featureCounts.tsv'.format(self.sample_name))
+            self.add_temp_file(fc_out)
+            self.add_temp_file(fc_out + '.summary')
+            lines = '{} '.format(featureCounts_path)
+            if paired:
+                lines += '-p -B -C '
+            lines += '-f -O -T {} '.format(self.threads)
+            if strand_specific:
+                lines += '-s 2 '
+            lines += (
+                '\\\n\t-F GTF -t exonic_part -g gene_id '
+                '--extraAttributes exonic_part_number \\\n\t'
+                '-a {} \\\n\t-o {} \\\n\t{}\n\n'.format(
+                    dexseq_annotation, fc_out, bam) +
+                # The script doesn't stop on errors so we exit here rather
+                # than writing a counts file from partial output.
+                'if [ $? -ne 0 ] ; then exit 1 ; fi\n\n' +
+                "awk -F '\\t' -v OFS='\\t' "
+                "'NR > 2 {{print $1 \":\" $7, $8}}' \\\n\t"
+                '{} > {}\n\n'.format(fc_out, counts_file)
+            )
+            self.add_lines(lines)
+            return counts_file
         if dexseq_count_path is None:
-            import readline
-            import rpy2.robjects as robjects
-            robjects.r('suppressPackageStartupMessages(library(DEXSeq))')
-            scripts = robjects.r('system.file("python_scripts", package="DEXSeq")')
-            g = scripts.items()
-            scripts_path = g.next()[1]
-            dexseq_count_path = os.path.join(scripts_path, 'dexseq_count.py')
+            dexseq_count_path = _dexseq_count_path()
         if paired:
             p = 'yes'
         else:
@@ -226,14 +397,21 @@ class RNAJobScript(JobScript):
             s = 'reverse'
         else:
             s = 'no'
+        # samtools passes the properly paired reads to dexseq_count.py as
+        # uncompressed bam. HTSeq reads the records with pysam so they aren't
+        # converted to text, cut, and parsed again. samtools uses the job's
+        # other threads to decompress the bam.
         lines = (
-            '{} view -h -f 2 {} \\\n\t'.format(samtools_path, bam) +
-            '| cut -f1-16,20- \\\n\t| python {} \\\n\t'.format(dexseq_count_path) + 
-            '-p {} -s {} -a 0 -r pos -f sam \\\n\t'.format(p, s) + 
-            '{} \\\n\t- {}\n\n'.format(dexseq_annotation, counts_file)
+            '{} view -u -@ {} -f 2 {} \\\n\t'.format(
+                samtools_path, self.threads - 1, bam) +
+            '| python {} \\\n\t'.format(dexseq_count_path) + 
+            '-p {} -s {} -a 0 -r pos -f bam \\\n\t'.format(p, s) + 
+            '{} \\\n\t- {}\n\n'.format(dexseq_annotation, counts_file) +
+            # The script doesn't stop on errors and the pipe's exit status is
+            # only dexseq_count.py's, so we check that samtools succeeded too.
+            'if [ "${PIPESTATUS[*]}" != "0 0" ] ; then exit 1 ; fi\n\n'
         )
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         return counts_file
     
     def htseq_count(
@@ -258,14 +436,6 @@ class RNAJobScript(JobScript):
         strand_specific : boolean
             True if the data is strand-specific. False otherwise.
     
-        Returns
-        -------
-        lines : str
-            Lines to be printed to shell script.
-    
-        name : str
-            File name for the softlink.
-   
         Returns
         -------
         counts_file : str
@@ -286,15 +456,17 @@ class RNAJobScript(JobScript):
             s = 'no'
         script = os.path.join(HTSeq.__path__[0], 'scripts', 'count.py')
         lines = ('python {} \\\n\t-f bam -r pos -s {} '.format(script, s) + 
-                 '-a 0 -t exon -i gene_id -m union \\\n\t' + 
-                 '{} \\\n\t{} \\\n\t> temp_out.tsv\n'.format(bam, gtf))
-        lines += 'tail -n 5 temp_out.tsv > {}\n'.format(stats_file)
-        lines += 'lines=$(wc -l <temp_out.tsv)\n'
-        lines += 'wanted=`expr $lines - 5`\n'
-        lines += 'head -n $wanted temp_out.tsv > {}\n'.format(counts_file)
-        lines += 'rm temp_out.tsv\n\n'
-        with open(self.filename, "a") as f:
-            f.write(lines)
+                 '-a 0 -t exon -i gene_id -m union \\\n\t'
+                 '{} \\\n\t{} \\\n\t'.format(bam, gtf))
+        # HTSeq's summary lines start with __ so we can split them off into the
+        # stats file as the counts stream by.
+        lines += ('| awk -v c={} -v s={} \\\n\t'
+                  '\'/^__/ {{print > s; next}} {{print > c}}\'\n\n'.format(
+                      counts_file, stats_file))
+        # The pipe's exit status is awk's, so without this a count.py crash
+        # would leave truncated counts and the job would still succeed.
+        lines += 'if [ "${PIPESTATUS[*]}" != "0 0" ] ; then exit 1 ; fi\n\n'
+        self.add_lines(lines)
         return counts_file, stats_file
 
     def bedgraph_from_bam(
@@ -302,6 +474,7 @@ class RNAJobScript(JobScript):
         bam, 
         strand=None,
         scale=None,
+        bg=False,
         bedtools_path='bedtools',
         sambamba_path='sambamba',
     ):
@@ -320,10 +493,17 @@ class RNAJobScript(JobScript):
         scale : float
             Scale the bigwig by this amount.
 
+        bg : boolean
+            Whether to run the process in the background.
+
         bedtools_path : str
             Path to bedtools. If bedtools_path == 'bedtools', it is assumed that
             the hg19 human.hg19.genome file from bedtools is also in your path.
 
+        sambamba_path : str
+            Path to sambamba executable. sambamba view uses all of the job's
+            threads to decompress the bam file unless bg is True.
+
         Returns
         -------
         bedgraph : str
@@ -336,47 +516,31 @@ class RNAJobScript(JobScript):
         elif strand == '-':
             fn_root += '_minus'
         if scale:
-            fn_root += '_scaled'.format(scale)
+            fn_root += '_scaled'
         bedgraph = os.path.join(self.tempdir, '{}.bg'.format(fn_root))
 
-        if bedtools_path == 'bedtools':
-            genome_file = 'human.hg19.genome'
-        else:
-            genome_file = os.path.join(
-                os.path.split(os.path.split(bedtools_path)[0])[0], 'genomes',
-                'human.hg19.genome')
+        genome_file = _bedtools_genome_file(bedtools_path)
 
-        if strand == '+':
-            lines = (
-                '{} view -f bam -F "((first_of_pair and mate_is_reverse_strand) '
-                'or (second_of_pair and reverse_strand)) and mapping_quality >= '
-                '255" \\\n\t{} \\\n\t| {} '
-                'genomecov -ibam stdin -g {} \\\n\t-split -bg -trackline '
-                '-trackopts \'name="{}"\' '.format(
-                    sambamba_path, bam, bedtools_path, genome_file, fn_root))
-        elif strand == '-':
-            lines = (
-                '{} view -f bam -F "((second_of_pair and mate_is_reverse_strand) '
-                'or (first_of_pair and reverse_strand)) and mapping_quality >= '
-                '255" \\\n\t{} \\\n\t| {} genomecov '
-                '-ibam stdin -g {} \\\n\t-split -bg -trackline -trackopts '
-                '\'name="{}"\' '.format(
-                    sambamba_path, bam, bedtools_path, genome_file, fn_root))
-        else:
-            lines = ('{} view -f bam -F "not (unmapped or mate_is_unmapped) and '
-                     'mapping_quality >= 255" \\\n\t{} \\\n\t| '
-                     '{} genomecov -ibam stdin \\\n\t-g {} -split -bg \\\n\t'
-                     '-trackline -trackopts \'name="{}"\' '.format(
-                         sambamba_path, bam, bedtools_path, genome_file,
-                         self.sample_name))
+        # bedtools genomecov is single threaded, so background processes only
+        # give sambamba one thread to leave the job's other threads for the
+        # other background processes.
+        threads = self.threads
+        if bg:
+            threads = 1
 
+        lines = ('{} view -t {} -f bam -F "{} and mapping_quality >= 255" '
+                 '\\\n\t{} \\\n\t| {} genomecov -ibam stdin -g {} '
+                 '\\\n\t-split -bg -trackline -trackopts \'name="{}"\''.format(
+                     sambamba_path, threads, _STRAND_FILTERS.get(strand),
+                     bam, bedtools_path, genome_file, fn_root))
         if scale:
             lines += ' -scale {}'.format(scale)
-        
-        lines += ' \\\n\t> {}\n\n'.format( bedgraph)
-
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        lines += ' \\\n\t> {}'.format(bedgraph)
+        if bg:
+            lines += ' &\n\n'
+        else:
+            lines += '\n\n'
+        self.add_lines(lines)
         return bedgraph
     
     def bigwig_from_bedgraph(
@@ -427,18 +591,12 @@ class RNAJobScript(JobScript):
             dy = self.outdir
         else:
             dy = self.tempdir
-        if bedtools_path == 'bedtools':
-            genome_file = '$(which human.hg19.genome)'
-        else:
-            genome_file = os.path.join(
-                os.path.split(os.path.split(bedtools_path)[0])[0], 'genomes',
-                'human.hg19.genome')
+        genome_file = _bedtools_genome_file(bedtools_path)
         root = os.path.splitext(os.path.split(bedgraph)[1])[0]
         bigwig = os.path.join(dy, '{}.bw'.format(root))
         lines = '{} \\\n\t{} \\\n\t{} \\\n\t{}\n\n'.format(
             bedGraphToBigWig_path, bedgraph, genome_file, bigwig)
-        with open(self.filename, "a") as f:
-            f.write(lines)
+        self.add_lines(lines)
         if web_available:
             name = '{}_rna'.format(self.sample_name)
             desc = 'RNAseq coverage for {}.'.format(self.sample_name)
@@ -609,6 +767,11 @@ def pipeline(
     bammarkduplicates_path='bammarkduplicates',
     featureCounts_path='featureCounts',
     fastq_dump_path='fastq-dump',
+    quantifier='rsem',
+    salmon_transcripts=None,
+    salmon_path='salmon',
+    allele_counter='gatk',
+    dexseq_counter='dexseq_count',
 ):
     """
     Make SGE/shell scripts for running the entire RNA-seq pipeline. The defaults
@@ -717,6 +880,12 @@ def pipeline(
         submit different jobs to the different queues on the Frazer lab cluster
         in an optimal way.
 
+    star_genome_load : str
+        STAR genomeLoad option for the alignment and WASP remapping jobs. Use
+        LoadAndKeep to share one copy of the genome in shared memory between
+        STAR jobs on the same node and submit remove_star_genome once they are
+        done.
+
     rgpl : str
         Read Group platform (e.g. illumina, solid). 
 
@@ -760,8 +929,31 @@ def pipeline(
         Path bedGraphToBigWig executable.
 
     dexseq_count_path : str
-        Path to dexseq_count.py script. If not provided, rpy2 will look for the
-        path in R.
+        Path to dexseq_count.py script. If not provided, Rscript will look for
+        the path in the DEXSeq installation.
+
+    quantifier : str
+        Either 'rsem' to estimate transcript expression with RSEM or 'salmon'
+        to use salmon's alignment-based mode on the same transcriptome bam.
+
+    salmon_transcripts : str
+        Fasta file with the transcript sequences for the STAR index's
+        annotation. Required if quantifier == 'salmon'.
+
+    salmon_path : str
+        Path to salmon executable.
+
+    allele_counter : str
+        Either 'gatk' to count alleles for ASE with GATK's ASEReadCounter or
+        'bcftools' to use bcftools mpileup. bcftools doesn't need the bam file
+        to be reordered to match gatk_fasta, but its counts can differ slightly
+        from GATK's where overlapping mates disagree (see
+        JobScript.count_allele_coverage).
+
+    dexseq_counter : str
+        Either 'dexseq_count' to count reads in DEXSeq exonic bins with
+        dexseq_count.py or 'featureCounts' to use featureCounts, which is
+        multithreaded.
     
     Returns
     -------
@@ -769,6 +961,15 @@ def pipeline(
         Path to submission shell script.
 
     """
+    if quantifier not in ['rsem', 'salmon']:
+        raise ValueError('Unknown quantifier {}.'.format(quantifier))
+    if quantifier == 'salmon' and salmon_transcripts is None:
+        raise ValueError('salmon_transcripts is required to quantify with '
+                         'salmon.')
+    if allele_counter not in ['gatk', 'bcftools']:
+        raise ValueError('Unknown allele_counter {}.'.format(allele_counter))
+    if dexseq_counter not in ['dexseq_count', 'featureCounts']:
+        raise ValueError('Unknown dexseq_counter {}.'.format(dexseq_counter))
     with open(webpath_file) as wpf:
         webpath = wpf.readline().strip()
 
@@ -784,13 +985,13 @@ def pipeline(
     else:
         default_queue = queue
 
-    ##### Job 1: Combine fastqs and align with STAR. #####
+    ##### Job 1: Combine fastqs, align, mark duplicates, and index. #####
     job = RNAJobScript(
         sample_name, 
         job_suffix='alignment',
         outdir=os.path.join(outdir, 'alignment'), 
         threads=8, 
-        memory=32,
+        memory=40,
         linkdir=linkdir,
         webpath=webpath,
         tempdir=tempdir, 
@@ -822,25 +1023,77 @@ def pipeline(
     r2_fastqs = [os.path.realpath(x) for x in r2_fastqs]
     combined_r1 = job.combine_fastqs(r1_fastqs, suffix='R1', bg=True)
     combined_r2 = job.combine_fastqs(r2_fastqs, suffix='R2', bg=True)
-    with open(job.filename, "a") as f:
-            f.write('\nwait\n\n')
+    job.add_lines('\nwait\n\n')
     # We don't want to keep the fastqs indefinitely, but we need them for the
     # fastQC step later.
     combined_r1 = job.add_output_file(combined_r1)
     combined_r2 = job.add_output_file(combined_r2)
 
-    # Align reads.
+    # Align reads, coordinate sort, and mark duplicates. STAR writes the
+    # unsorted alignments to a named pipe that samtools sorts from, and
+    # samtools writes the sorted bam to a named pipe that bammarkduplicates
+    # reads from, so only the bam with duplicates marked is written to disk.
+    star_bam = os.path.join(job.tempdir, '{}.bam'.format(job.sample_name))
+    coord_sorted_bam = os.path.join(
+        job.tempdir, '{}_sorted.bam'.format(job.sample_name))
+    job.add_lines('mkfifo {} {}\n\n'.format(star_bam, coord_sorted_bam))
+    # STAR and bammarkduplicates run at the same time as the sort, and STAR
+    # holds the genome in memory, so samtools only gets a small share.
+    job.samtools_sort(
+        star_bam, 
+        mem_per_thread='768M',
+        bg=True,
+        samtools_path=samtools_path,
+    )
+    job.add_lines('sort_pid=$!\n\n')
+    mdup_bam, duplicate_metrics, bam_index = job.biobambam2_mark_duplicates(
+        coord_sorted_bam,
+        bg=True,
+        index=True,
+        bammarkduplicates_path=bammarkduplicates_path)
+    job.add_lines('mdup_pid=$!\n\n')
     (star_bam, log_out, log_final_out, log_progress_out, sj_out, 
      transcriptome_bam) = \
             job.star_align(combined_r1, combined_r2, rgpl, rgpu, star_index,
-                            job.threads, genome_load=star_genome_load)
-    star_bam = job.add_output_file(star_bam)
+                           job.threads, genome_load=star_genome_load,
+                           read_files_command='pigz -dc', stream_bam=True,
+                           bg=True)
+    job.add_lines('star_pid=$!\n\n')
+    # If any of the three fails, the others are killed rather than left
+    # blocked on the named pipes and the job exits.
+    job.wait_for_background(['star_pid', 'sort_pid', 'mdup_pid'],
+                            [star_bam, coord_sorted_bam])
     transcriptome_bam = job.add_output_file(transcriptome_bam)
     log_final_out = job.add_output_file(log_final_out)
     [job.add_output_file(x) for x in [log_out, log_progress_out, sj_out]]
+    outdir_mdup_bam = job.add_output_file(mdup_bam)
+    job.add_output_file(duplicate_metrics)
+
+    # Add softlink to bam file in outdir and write URL and trackline.
+    link = job.add_softlink(outdir_mdup_bam)
+    name = '{}_rna'.format(job.sample_name)
+    desc = 'RNAseq alignment for {}.'.format(job.sample_name)
+    url = job.webpath + '/' + os.path.split(outdir_mdup_bam)[1]
+    t_lines = (
+        'track type=bam name="{}" '
+        'description="{}" '
+        'visibility=0 db=hg19 bigDataUrl={}\n'.format(
+            name, desc, url))
+    with open(job.links_tracklines, "a") as f:
+        f.write(t_lines)
+        f.write(url + '\n')
+
+    # bammarkduplicates indexed the bam file while writing it.
+    outdir_bam_index = job.add_output_file(bam_index)
+    link = job.add_softlink(outdir_bam_index)
+
     job.write_end()
     if not job.delete_sh:
         submit_commands.append(job.sge_submit_command())
+    
+    # These files will be input for upcoming scripts.
+    mdup_bam = outdir_mdup_bam
+    bam_index = outdir_bam_index
 
     ##### Job 2: Run fastQC. ##### 
     job = RNAJobScript(
@@ -872,97 +1125,35 @@ def pipeline(
     if not job.delete_sh:
         submit_commands.append(job.sge_submit_command())
 
-    ##### Job 3: Coordinate sort, mark duplicates and index bam. #####
-    job = RNAJobScript(
-        sample_name, 
-        job_suffix = 'sort_mdup_index',
-        outdir=os.path.join(outdir, 'alignment'), 
-        threads=4, 
-        memory=6,
-        linkdir=linkdir,
-        webpath=webpath,
-        tempdir=tempdir, 
-        queue=default_queue, 
-        conda_env=conda_env,
-        modules=modules,
-        wait_for=[alignment_jobname]
-    )
-    sort_mdup_index_jobname = job.jobname
-
-    # Input files.
-    star_bam = job.add_input_file(star_bam, delete_original=True)
-
-    # Coordinate sort.
-    coord_sorted_bam = job.sambamba_sort(
-        star_bam, 
-        tempdir=job.tempdir,
-        sambamba_path=sambamba_path,
-    )
-    job.add_temp_file(coord_sorted_bam)
-
-    # Index sorted bam file.
-    temp_bam_index = job.sambamba_index(coord_sorted_bam, sambamba_path)
-    job.add_temp_file(temp_bam_index)
-
-    # Mark duplicates.
-    mdup_bam, duplicate_metrics = job.biobambam2_mark_duplicates(
-        coord_sorted_bam,
-        bammarkduplicates_path=bammarkduplicates_path)
-    outdir_mdup_bam = job.add_output_file(mdup_bam)
-    job.add_output_file(duplicate_metrics)
-
-    # Add softlink to bam file in outdir and write URL and trackline.
-    link = job.add_softlink(outdir_mdup_bam)
-    name = '{}_rna'.format(job.sample_name)
-    desc = 'RNAseq alignment for {}.'.format(job.sample_name)
-    url = job.webpath + '/' + os.path.split(outdir_mdup_bam)[1]
-    t_lines = (
-        'track type=bam name="{}" '
-        'description="{}" '
-        'visibility=0 db=hg19 bigDataUrl={}\n'.format(
-            name, desc, url))
-    with open(job.links_tracklines, "a") as f:
-        f.write(t_lines)
-        f.write(url + '\n')
-
-    # Index bam file.
-    bam_index = job.sambamba_index(mdup_bam, sambamba_path)
-    outdir_bam_index = job.add_output_file(bam_index)
-    link = job.add_softlink(outdir_bam_index)
-
-    job.write_end()
-    if not job.delete_sh:
-        submit_commands.append(job.sge_submit_command())
-    
-    # These files will be input for upcoming scripts.
-    mdup_bam = outdir_mdup_bam
-    bam_index = outdir_bam_index
-
-    ##### Job 4: Collect Picard metrics. #####
+    ##### Job 3: Collect Picard metrics. #####
     job = RNAJobScript(
         sample_name, 
         job_suffix='picard_metrics',
         outdir=os.path.join(outdir, 'qc'),
-        threads=1, 
-        memory=7, 
+        threads=3, 
+        memory=21, 
         linkdir=linkdir,
         webpath=webpath,
         tempdir=tempdir, 
         queue=default_queue,
         conda_env=conda_env, 
         modules=modules,
-        wait_for=[sort_mdup_index_jobname],
+        wait_for=[alignment_jobname],
+        java_processes=3,
     )
     picard_metrics_jobname = job.jobname
     
     # Input files.
     mdup_bam = job.add_input_file(mdup_bam)
 
+    # The three Picard tools each read the whole bam file so they run at the
+    # same time.
+
     # Collect several different Picard metrics including insert size.
     metrics_files = job.picard_collect_multiple_metrics(
         mdup_bam, 
         picard_path=picard_path, 
-        bg=False,
+        bg=True,
     )
     for fn in metrics_files:
         job.add_output_file(fn)
@@ -974,7 +1165,7 @@ def pipeline(
         rrna_intervals,
         picard_path=picard_path,
         strand_specific=strand_specific, 
-        bg=False,
+        bg=True,
     )
     job.add_output_file(metrics)
     job.add_output_file(chart)
@@ -983,16 +1174,17 @@ def pipeline(
     index_out, index_err = job.picard_bam_index_stats(
         mdup_bam, 
         picard_path=picard_path,
-        bg=False,
+        bg=True,
     )
     job.add_output_file(index_out)
     job.add_output_file(index_err)
+    job.add_lines('wait\n\n')
 
     job.write_end()
     if not job.delete_sh:
         submit_commands.append(job.sge_submit_command())
 
-    ##### Job 5: Make md5 hash for final bam file. #####
+    ##### Job 4: Make md5 hash for final bam file. #####
     job = RNAJobScript(
         sample_name, 
         job_suffix='md5',
@@ -1005,7 +1197,7 @@ def pipeline(
         queue=default_queue, 
         conda_env=conda_env,
         modules=modules,
-        wait_for=[sort_mdup_index_jobname],
+        wait_for=[alignment_jobname],
     )
     md5_jobname = job.jobname
     
@@ -1020,33 +1212,55 @@ def pipeline(
     if not job.delete_sh:
         submit_commands.append(job.sge_submit_command())
        
-    ##### Job 6: Make bigwig files for final bam file. #####
+    ##### Job 5: Make bigwig files for final bam file. #####
     job = RNAJobScript(
         sample_name, 
         job_suffix='bigwig',
         outdir=os.path.join(outdir, 'alignment'), 
-        threads=1, 
-        memory=4,
+        threads=3, 
+        memory=8,
         linkdir=linkdir,
         webpath=webpath,
         tempdir=tempdir, 
         queue=default_queue, 
         conda_env=conda_env,
         modules=modules,
-        wait_for=[sort_mdup_index_jobname],
+        wait_for=[alignment_jobname],
     )
     bigwig_jobname = job.jobname
         
     # Input files.
     mdup_bam = job.add_input_file(mdup_bam)
 
-    # First make bigwig from both strands.
+    # Make bedgraphs for both strands, the plus strand, and the minus strand.
+    # These each read the bam file independently so they run at the same
+    # time.
     bg = job.bedgraph_from_bam(
         mdup_bam, 
+        bg=True,
         bedtools_path=bedtools_path,
         sambamba_path=sambamba_path,
     )
     job.add_temp_file(bg)
+    plus_bg = job.bedgraph_from_bam(
+        mdup_bam, 
+        strand='+',
+        bg=True,
+        bedtools_path=bedtools_path,
+        sambamba_path=sambamba_path,
+    )
+    job.add_temp_file(plus_bg)
+    minus_bg = job.bedgraph_from_bam(
+        mdup_bam, 
+        strand='-',
+        bg=True,
+        bedtools_path=bedtools_path,
+        sambamba_path=sambamba_path,
+    )
+    job.add_temp_file(minus_bg)
+    job.add_lines('wait\n\n')
+
+    # First make bigwig from both strands.
     bw = job.bigwig_from_bedgraph(
         bg,
         bedGraphToBigWig_path=bedGraphToBigWig_path,
@@ -1055,13 +1269,6 @@ def pipeline(
     job.add_output_file(bw)
 
     # Now for genes on the plus strand.
-    plus_bg = job.bedgraph_from_bam(
-        mdup_bam, 
-        strand='+',
-        bedtools_path=bedtools_path,
-        sambamba_path=sambamba_path,
-    )
-    job.add_temp_file(plus_bg)
     plus_bw = job.bigwig_from_bedgraph(
         plus_bg,
         strand='+',
@@ -1072,13 +1279,6 @@ def pipeline(
     plus_bw = job.add_output_file(plus_bw)
 
     # Now for genes on the minus strand.
-    minus_bg = job.bedgraph_from_bam(
-        mdup_bam, 
-        strand='-',
-        bedtools_path=bedtools_path,
-        sambamba_path=sambamba_path,
-    )
-    job.add_temp_file(minus_bg)
     minus_bw = job.bigwig_from_bedgraph(
         minus_bg,
         strand='-',
@@ -1155,27 +1355,27 @@ def pipeline(
     if not job.delete_sh:
         submit_commands.append(job.sge_submit_command())
     
-    ##### Job 7: Get featureCounts and DEXSeq counts. #####
+    ##### Job 6: Get featureCounts and DEXSeq counts. #####
     job = RNAJobScript(
         sample_name, 
         job_suffix = 'counts',
         outdir=os.path.join(outdir, 'counts'), 
-        threads=1, 
-        memory=4,
+        threads=8, 
+        memory=8,
         linkdir=linkdir,
         webpath=webpath,
         tempdir=tempdir, 
         queue=default_queue, 
         conda_env=conda_env,
         modules=modules,
-        wait_for=[sort_mdup_index_jobname],
+        wait_for=[alignment_jobname],
     )
     counts_jobname = job.jobname
     
     # Input files.
     mdup_bam = job.add_input_file(mdup_bam)
 
-    # Get gene counts.
+    # Get gene counts. featureCounts uses all of the job's threads.
     if strand_specific:
         ss = 2
     else:
@@ -1198,6 +1398,8 @@ def pipeline(
         strand_specific=strand_specific,
         dexseq_count_path=dexseq_count_path,
         samtools_path=samtools_path,
+        use_featureCounts=dexseq_counter == 'featureCounts',
+        featureCounts_path=featureCounts_path,
     )
     job.add_output_file(dexseq_counts)
 
@@ -1205,11 +1407,11 @@ def pipeline(
     if not job.delete_sh:
         submit_commands.append(job.sge_submit_command())
     
-    ##### Job 8: Run RSEM. #####
+    ##### Job 7: Run RSEM or salmon. #####
     job = RNAJobScript(
         sample_name, 
-        job_suffix = 'rsem',
-        outdir=os.path.join(outdir, 'rsem'),
+        job_suffix = quantifier,
+        outdir=os.path.join(outdir, quantifier),
         threads=8, 
         memory=32, 
         linkdir=linkdir,
@@ -1217,25 +1419,33 @@ def pipeline(
         tempdir=tempdir, queue=default_queue,
         conda_env=conda_env, 
         modules=modules,
-        wait_for=[sort_mdup_index_jobname],
+        wait_for=[alignment_jobname],
     )
     rsem_jobname = job.jobname
     
     # Input files.
     transcriptome_bam = job.add_input_file(transcriptome_bam)
 
-    # Run RSEM.
-    genes, isoforms, stats = job.rsem_calculate_expression(
-        transcriptome_bam, 
-        rsem_reference, 
-        threads=job.threads, 
-        ci_mem=1024,
-        strand_specific=strand_specific,
-        rsem_calculate_expression_path=rsem_calculate_expression_path,
-    )
-    job.add_output_file(genes)
-    job.add_output_file(isoforms)
-    job.add_output_file(stats)
+    if quantifier == 'salmon':
+        # Run salmon.
+        salmon_dir = job.salmon_quant(
+            transcriptome_bam, 
+            salmon_transcripts, 
+            strand_specific=strand_specific,
+            salmon_path=salmon_path,
+        )
+        job.add_output_file(salmon_dir)
+    else:
+        # Run RSEM.
+        genes, isoforms, stats = job.rsem_calculate_expression(
+            transcriptome_bam, 
+            rsem_reference, 
+            strand_specific=strand_specific,
+            rsem_calculate_expression_path=rsem_calculate_expression_path,
+        )
+        job.add_output_file(genes)
+        job.add_output_file(isoforms)
+        job.add_output_file(stats)
 
     job.write_end()
     if not job.delete_sh:
@@ -1243,12 +1453,12 @@ def pipeline(
    
     # We'll only go through the ASE steps if a VCF was provided.
     if vcfs:
-        ##### Job 9: WASP first step. #####
+        ##### Job 8: WASP first step. #####
         job = RNAJobScript(
             sample_name, 
             job_suffix = 'wasp_allele_swap',
             outdir=os.path.join(outdir, 'wasp'),
-            threads=1, 
+            threads=4, 
             memory=4, 
             linkdir=linkdir,
             webpath=webpath,
@@ -1256,7 +1466,7 @@ def pipeline(
             queue=default_queue,
             conda_env=conda_env, 
             modules=modules,
-            wait_for=[sort_mdup_index_jobname],
+            wait_for=[alignment_jobname],
         )
         wasp_allele_swap_jobname = job.jobname
            
@@ -1283,6 +1493,7 @@ def pipeline(
              vcf_chrom_conv=vcf_chrom_conv,
              samtools_path=samtools_path,
              bcftools_path=bcftools_path,
+             bedtools_path=bedtools_path,
         )
         # WASP outputs a file (keep_bam) that has reads that don't overlap
         # variants. I'm going to discard that file. I'll discard the WASP SNP
@@ -1299,7 +1510,7 @@ def pipeline(
         if not job.delete_sh:
             submit_commands.append(job.sge_submit_command())
         
-        ##### Job 10: WASP second step. #####
+        ##### Job 9: WASP second step. #####
         job = RNAJobScript(
             sample_name, 
             job_suffix='wasp_remap',
@@ -1325,7 +1536,8 @@ def pipeline(
                 job.star_align(wasp_r1_fastq, wasp_r2_fastq, rgpl, rgpu,
                                star_index, job.threads,
                                genome_load=star_genome_load,
-                               transcriptome_align=False)
+                               transcriptome_align=False,
+                               read_files_command='pigz -dc')
         job.add_output_file(remapped_bam)
         job.add_output_file(log_out)
         job.add_output_file(log_final_out)
@@ -1336,7 +1548,7 @@ def pipeline(
         if not job.delete_sh:
             submit_commands.append(job.sge_submit_command())
         
-        ##### Job 11: WASP third step. #####
+        ##### Job 10: WASP third step. #####
         job = RNAJobScript(
             sample_name, 
             job_suffix = 'wasp_alignment_compare',
@@ -1358,57 +1570,59 @@ def pipeline(
         to_remap_num = job.add_input_file(to_remap_num, delete_original=True)
         remapped_bam = job.add_input_file(remapped_bam, delete_original=True)
 
-        # Compare alignments.
-        temp_filtered_bam = job.wasp_alignment_compare(
+        # Compare alignments. The filtered reads are coordinate sorted and
+        # indexed.
+        wasp_filtered_bam, wasp_bam_index = job.wasp_alignment_compare(
             to_remap_bam, 
             to_remap_num,
             remapped_bam, 
             filter_remapped_reads_path,
         )
-        job.add_temp_file(temp_filtered_bam)
-            
-        # Coordinate sort and index filtered bam file.
-        wasp_filtered_bam, wasp_bam_index = job.picard_coord_sort(
-            temp_filtered_bam, 
-            index=True,
-            picard_path=picard_path,
-        )
         # I'll keep this bam file and its index as a record of which reads were
         # used to calculate ASE. It might be useful for visualization. The bam
         # file is pretty small anyway.
         job.add_output_file(wasp_filtered_bam)
         job.add_output_file(wasp_bam_index)
 
-        # Reorder bam file so it will work with GATK.
-        reordered_bam = job.picard_reorder(
-            wasp_filtered_bam, 
-            fasta=gatk_fasta,
-            picard_path=picard_path,
-        )
-        job.add_temp_file(reordered_bam)
-
-        # Index reordered bam.
-        reordered_index = job.picard_index(
-            reordered_bam, 
-            picard_path=picard_path,
-            bg=False,
-        )
-        job.add_temp_file(reordered_index)
-
-        # Get allele counts.
-        allele_counts = job.count_allele_coverage(
-            reordered_bam, 
-            hets_vcf,
-            gatk_fasta, 
-            gatk_path=gatk_path,
-        )
+        if allele_counter == 'bcftools':
+            # Get allele counts.
+            allele_counts = job.count_allele_coverage(
+                wasp_filtered_bam, 
+                hets_vcf,
+                gatk_fasta, 
+                use_bcftools=True,
+                bcftools_path=bcftools_path,
+            )
+        else:
+            # Reorder bam file so it will work with GATK.
+            reordered_bam = job.picard_reorder(
+                wasp_filtered_bam, 
+                fasta=gatk_fasta,
+                picard_path=picard_path,
+            )
+            job.add_temp_file(reordered_bam)
+
+            # Index reordered bam.
+            reordered_index = job.samtools_index(
+                reordered_bam, 
+                samtools_path=samtools_path,
+            )
+            job.add_temp_file(reordered_index)
+
+            # Get allele counts.
+            allele_counts = job.count_allele_coverage(
+                reordered_bam, 
+                hets_vcf,
+                gatk_fasta, 
+                gatk_path=gatk_path,
+            )
         job.add_output_file(allele_counts)
 
         job.write_end()
         if not job.delete_sh:
             submit_commands.append(job.sge_submit_command())
         
-        ##### Job 12: Run MBASED for ASE. #####
+        ##### Job 11: Run MBASED for ASE. #####
         if queue == 'frazer':
             q = 'opt'
         else:
@@ -1432,12 +1646,31 @@ def pipeline(
         # Input files.
         allele_counts = job.add_input_file(allele_counts)
 
+        # Keep just this sample's genotypes so that looking for variants near
+        # each heterozygous SNV doesn't parse the genotypes of every sample in
+        # the VCFs.
+        sample_vcfs = []
+        pids = []
+        for i, vcf in enumerate(input_vcfs):
+            sample_vcf, sample_vcf_index = job.sample_vcf(
+                vcf, 
+                vcf_sample_name, 
+                bg=True,
+                bcftools_path=bcftools_path,
+            )
+            pids.append('sample_vcf_pid_{}'.format(i + 1))
+            job.add_lines('{}=$!\n\n'.format(pids[-1]))
+            job.add_temp_file(sample_vcf)
+            job.add_temp_file(sample_vcf_index)
+            sample_vcfs.append(sample_vcf)
+        job.wait_for_background(pids)
+
         mbased_infile, locus_outfile, snv_outfile = job.mbased(
             allele_counts, 
             gene_bed, 
             is_phased=is_phased, 
             num_sim=1000000, 
-            vcfs=input_vcfs,
+            vcfs=sample_vcfs,
             vcf_sample_name=vcf_sample_name, 
             vcf_chrom_conv=vcf_chrom_conv,
             mappability=mappability,
@@ -1466,3 +1699,69 @@ def pipeline(
         return submit_fn
     else:
         return None
+
+def remove_star_genome(
+    star_index,
+    outdir,
+    wait_for,
+    conda_env=None,
+    modules=None,
+    queue=None,
+    tempdir=None,
+    star_path='STAR',
+):
+    """
+    Make a SGE/shell script that removes a STAR genome from shared memory after
+    the jobs in wait_for finish. Use this with star_genome_load='LoadAndKeep'.
+    Shared memory belongs to a node, so this only frees the genome on the node
+    the job runs on.
+
+    Parameters
+    ----------
+    star_index : str
+        Path to STAR index.
+
+    outdir : str
+        Directory to store shell scripts and stdout/stderr logs.
+
+    wait_for : list
+        List of job names to wait for (e.g. the alignment and WASP remapping
+        jobs of all samples).
+
+    conda_env : str
+        Conda environment to load at the beginning of the script.
+
+    modules : str
+        Comma-separated list of modules to load at the beginning of the script.
+
+    queue : str
+        Name of queue to submit the job to.
+
+    tempdir : str
+        Directory to store temporary files.
+
+    star_path : str
+        Path to STAR aligner.
+
+    Returns
+    -------
+    submit_command : str
+        Command to submit the job. None if the job script was not written.
+
+    """
+    job = RNAJobScript(
+        os.path.split(os.path.normpath(star_index))[1],
+        job_suffix='star_remove_genome',
+        outdir=os.path.join(outdir, 'star_remove_genome'),
+        threads=1, 
+        memory=1,
+        tempdir=tempdir, 
+        queue=queue, 
+        conda_env=conda_env,
+        modules=modules,
+        wait_for=wait_for,
+    )
+    job.star_remove_genome(star_index, star_path=star_path)
+    job.write_end()
+    if not job.delete_sh:
+        return job.sge_submit_command()
@@ -1,4 +1,8 @@
 import argparse
+import csv
+import os
+import shutil
+import subprocess
 
 def scale_bedgraph(bg, out_bg, actual_num, expected_num):
     """
@@ -49,19 +53,43 @@ def scale_bedgraph(bg, out_bg, actual_num, expected_num):
         Full path to softlink.
     
     """
-    import subprocess
+    if actual_num == 0:
+        raise ValueError('Cannot scale {}, actual_num is zero.'.format(bg))
     factor = expected_num / float(actual_num)
-    c = ('grep -v ^track {} | awk \'OFS="\\t" {{$4 = $4 * {}}} '
-         '{{print $0}}\' > {}'.format(bg, factor, out_bg))
-    subprocess.check_call(c, shell=True)
+    # bedtools writes a trackline at the top of the bedgraph. We skip it
+    # instead of parsing it with the coverage.
+    skip = 0
+    with open(bg) as f:
+        line = f.readline()
+        while line.startswith('track'):
+            skip += 1
+            line = f.readline()
+        if factor == 1 or line == '':
+            # The coverage doesn't change (or there is none), so we just copy
+            # the rest of the file.
+            with open(out_bg, 'w') as out:
+                out.write(line)
+                shutil.copyfileobj(f, out)
+            return
+    import pandas as pd
+    # The bedgraph is read in chunks so it never has to fit in memory, and the
+    # coverage column of each chunk is scaled with one vectorized multiply.
+    # Coverage is written with %.6g, which is awk's default number format.
+    reader = pd.read_table(bg, header=None, skiprows=skip, chunksize=1000000,
+                           dtype={0: str, 1: int, 2: int, 3: float},
+                           quoting=csv.QUOTE_NONE)
+    with open(out_bg, 'w') as out:
+        for chunk in reader:
+            chunk[3] *= factor
+            chunk.to_csv(out, sep='\t', header=False, index=False,
+                         float_format='%.6g')
 
 def num_reads(fn, sambamba_path='sambamba'):
     """Get the number of read pairs in a bam file. The total number of reads is
     divided by 2 to return read pairs."""
-    import subprocess
-    c = ('{} view -c -F "not (unmapped or mate_is_unmapped) and '
-         'mapping_quality >= 255" {}'.format(sambamba_path, fn))
-    count = subprocess.check_output(c, shell=True)
+    c = [sambamba_path, 'view', '-c', '-F',
+         'not (unmapped or mate_is_unmapped) and mapping_quality >= 255', fn]
+    count = subprocess.check_output(c)
     return int(count.strip()) / 2
 
 def main():
@@ -94,8 +122,6 @@ def main():
                         default='sambamba',
                         help=('Path to sambamba.'))
 
-    import os
-
     args = parser.parse_args()
     bg = os.path.realpath(args.bg)
     bam = os.path.realpath(args.bam)
@@ -0,0 +1,29 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+@pytest.fixture
+def make_job():
+    """Factory for job scripts that write to path/ in the current directory.
+    path/ is removed after the test."""
+    def make(job_class):
+        # The script runs in the temp directory so the output directory needs
+        # to be an absolute path.
+        return job_class('test', 'test', os.path.abspath('path/to/out'), 4, 8,
+                         tempdir='path/to/temp')
+    yield make
+    if os.path.exists('path'):
+        shutil.rmtree('path')
+
+@pytest.fixture
+def write_script():
+    """Write the script for a job and return its text after checking that it
+    passes bash -n."""
+    def write(job):
+        job.write_end()
+        assert subprocess.call(['bash', '-n', job.filename]) == 0
+        with open(job.filename) as f:
+            return f.read()
+    return write
@@ -0,0 +1,217 @@
+import os
+import subprocess
+
+import pytest
+
+import cdpipelines as ps
+
+@pytest.fixture
+def job(make_job):
+    return make_job(ps.general.JobScript)
+
+class TestJobScriptSyntax:
+    def test_run(self, job, write_script):
+        """Test that a shell script with several commands passes bash -n"""
+        job.cutadapt_trim('test.fastq.gz', 50, 'test_cut.fastq.gz')
+        job.combine_fastqs(['a.fastq.gz', 'b.fastq.gz'], suffix='R1')
+        job.flagstat('test.bam')
+        job.picard_query_sort('test.bam')
+        job.picard_coord_sort('test.bam', index=True)
+        job.picard_mark_duplicates('test.bam')
+        job.wasp_allele_swap('test.bam', 'find_intersecting_snps.py',
+                             ['test.vcf.gz'], 'test.bed', gatk_fai='test.fai')
+        job.wasp_alignment_compare('test.to.remap.bam', 'test.to.remap.num.gz',
+                                   'test.remapped.bam',
+                                   'filter_remapped_reads.py')
+        job.add_output_file('test.bam')
+        write_script(job)
+
+class TestFifoChain:
+    def test_sort_mark_duplicates(self, job, write_script):
+        """Test a named pipe chain of samtools sort and bammarkduplicates"""
+        fifo = os.path.join(job.tempdir, 'test_sorted.bam')
+        job.add_lines('mkfifo {}\n\n'.format(fifo))
+        job.samtools_sort('test.bam', bg=True)
+        mdup_bam = job.biobambam2_mark_duplicates(fifo, bg=True,
+                                                  index=True)[0]
+        job.add_lines('wait\n\nrm {}\n\n'.format(fifo))
+        job.add_output_file(mdup_bam)
+        lines = write_script(job)
+        assert lines.index('mkfifo {}'.format(fifo)) < lines.index('wait')
+        assert lines.count(' &\n') == 2
+
+    def test_wasp(self, job, write_script):
+        """Test that WASP reads the bam from a named pipe that samtools writes
+        to in the background"""
+        out = job.wasp_allele_swap('test.bam', 'find_intersecting_snps.py',
+                                   ['test.vcf.gz'], 'test.bed',
+                                   gatk_fai='test.fai')
+        job.add_output_file(out[1])
+        lines = write_script(job)
+        fifo = os.path.join(job.tempdir, 'test_uniq.bam')
+        assert 'mkfifo {}\n'.format(fifo) in lines
+        assert '> {} &\n\nsamtools_pid=$!\n'.format(fifo) in lines
+        assert 'pids="$samtools_pid $wasp_pid"\n' in lines
+        assert 'done\n\nrm -f {}\n'.format(fifo) in lines
+
+    def test_wasp_alignment_compare(self, job, write_script):
+        """Test that the job waits on the WASP filter and samtools sort
+        separately"""
+        out = job.wasp_alignment_compare(
+            'test.to.remap.bam', 'test.to.remap.num.gz', 'test.remapped.bam',
+            'filter_remapped_reads.py')
+        job.add_output_file(out[0])
+        lines = write_script(job)
+        fifo = os.path.join(job.tempdir, 'test_filtered.bam')
+        assert '{} &\n\nsort_pid=$!\n'.format(fifo) in lines
+        assert 'pids="$filter_pid $sort_pid"\n' in lines
+        assert 'done\n\nrm -f {}\n'.format(fifo) in lines
+
+class TestWaitForBackground:
+    def _run(self, job, write_script, producer):
+        fifo = os.path.join(job.tempdir, 'test.fifo')
+        job.add_lines('mkfifo {}\n\n'.format(fifo))
+        job.add_lines('{} &\n\nproducer_pid=$!\n\n'.format(
+            producer.format(fifo)))
+        job.add_lines('cat {} > /dev/null &\n\nconsumer_pid=$!\n\n'.format(
+            fifo))
+        job.wait_for_background(['producer_pid', 'consumer_pid'], [fifo])
+        write_script(job)
+        status = subprocess.call(['timeout', '60', 'bash', job.filename])
+        assert not os.path.exists(fifo)
+        return status
+
+    def test_run(self, job, write_script):
+        """Test that the script continues if the processes succeed"""
+        assert self._run(job, write_script, 'echo test > {}') == 0
+
+    def test_fail(self, job, write_script):
+        """Test that the script exits instead of hanging if a process fails
+        before opening its named pipe"""
+        assert self._run(job, write_script, '(exit 3) && echo test > {}') == 1
+
+class TestRunArrayTasks:
+    def test_run(self, job, write_script):
+        """Test that each array task gets its own temp directory and logs"""
+        tempdir = job.tempdir
+        job.run_array_tasks(['a.sh', 'b.sh'])
+        job.add_output_file('test.txt')
+        lines = write_script(job)
+        assert job.tempdir == tempdir + '_$SGE_TASK_ID'
+        assert 'mkdir -p {}\n'.format(job.tempdir) in lines
+        assert '.$TASK_ID.out\n' in lines
+        assert '.$TASK_ID.err\n' in lines
+        assert '\t1) bash a.sh ;;\n\t2) bash b.sh ;;\n' in lines
+        assert 'rm -r {}\n'.format(job.tempdir) in lines
+        assert job.sge_submit_command().startswith('qsub -t 1-2 ')
+
+class TestSampleVcf:
+    def test_run(self, job, write_script):
+        """Test that only the samples are subset so the nearby variant filter
+        sees every record"""
+        out, out_index = job.sample_vcf('test.vcf.gz', 'sample')
+        job.add_output_file(out)
+        lines = write_script(job)
+        assert ('bcftools view -Oz -s sample \\\n\t-o {} \\\n\t'
+                'test.vcf.gz \\\n\t&& bcftools index -t {}\n'.format(
+                    out, out)) in lines
+
+class TestSamtoolsSort:
+    def test_run(self, job, write_script):
+        """Test that the sort memory is split between the job's threads"""
+        job.add_output_file(job.samtools_sort('test.bam'))
+        lines = write_script(job)
+        # 80% of 8G shared by 4 threads.
+        assert 'sort -@ 3 -m 1638M \\\n' in lines
+
+    def test_mem_per_thread(self, job, write_script):
+        """Test giving the memory per thread explicitly"""
+        job.add_output_file(job.samtools_sort('test.bam',
+                                              mem_per_thread='768M'))
+        lines = write_script(job)
+        assert 'sort -@ 3 -m 768M \\\n' in lines
+
+class TestSamtoolsMerge:
+    def test_run(self, job, write_script):
+        """Test that the output file is given positionally"""
+        out = job.samtools_merge(['a.bam', 'b.bam'])
+        job.add_output_file(out)
+        lines = write_script(job)
+        assert 'merge -@ 3 -c -p \\\n\t{} \\\n\ta.bam'.format(out) in lines
+        assert 'merge -o' not in lines
+
+    def test_index(self, job, write_script):
+        """Test that the index is written with the merged file"""
+        out, out_index = job.samtools_merge(['a.bam', 'b.bam'], index=True)
+        job.add_output_file(out)
+        job.add_output_file(out_index)
+        lines = write_script(job)
+        assert '--write-index \\\n\t{}##idx##{} '.format(
+            out, out_index) in lines
+
+    def test_regions(self, job, write_script):
+        """Test merging each region separately and concatenating the parts"""
+        out = job.samtools_merge(['a.bam', 'b.bam'], regions=['chr1', 'chr2'],
+                                 index=True)[0]
+        job.add_output_file(out)
+        lines = write_script(job)
+        assert 'regions=$(samtools view -H a.bam \\\n' in lines
+        assert '-v regions=\'chr1 chr2\'' in lines
+        assert '"$(echo $regions | wc -w)" -ne 2 ]' in lines
+        assert 'parallel --jobs 4 ' in lines
+        assert '::: $regions\n' in lines
+        assert 'cat -o {} '.format(out) in lines
+
+    def test_region_order(self):
+        """Test that the regions are put in the header's @SQ order"""
+        header = ''.join(['@HD\tVN:1.4\tSO:coordinate\n',
+                          '@SQ\tSN:chr1\tLN:10\n',
+                          '@SQ\tSN:chr2\tLN:10\n',
+                          '@SQ\tSN:chrX\tLN:10\n'])
+        p = subprocess.Popen(
+            ['awk', '-v', 'regions=chrX chr2:5-9 chr1 chr2:1-4',
+             ps.general._REGION_ORDER_AWK],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out = p.communicate(header)[0]
+        order = [x.split()[2] for x in sorted(
+            out.splitlines(), key=lambda x: map(int, x.split()[:2]))]
+        assert order == ['chr1', 'chr2:5-9', 'chr2:1-4', 'chrX']
+
+    def test_regions_bg(self, job):
+        """Test that merging by region can't be run in the background"""
+        with pytest.raises(ValueError):
+            job.samtools_merge(['a.bam', 'b.bam'], regions=['chr1'], bg=True)
+
+class TestCopyOutputFiles:
+    def test_run(self, job, write_script):
+        """Test that outputs are moved out of the temp directory but outputs
+        already in the output directory are left alone"""
+        temp_out = os.path.join(job.tempdir, 'a.txt')
+        job.add_output_file(temp_out)
+        job.add_output_file('b.txt')
+        job.add_output_file(os.path.join(job.outdir, 'c.txt'))
+        lines = write_script(job)
+        assert '\t\tmv -f "$f" {}\n'.format(job.outdir) in lines
+        files = lines.split("fi <<'EOF'\n")[1].split('EOF\n')[0]
+        assert files.split('\n')[:-1] == [
+            temp_out, os.path.join(job.tempdir, 'b.txt')]
+
+    def test_replace_directory(self, job, write_script):
+        """Test that an output directory from an earlier run is replaced"""
+        out_dir = os.path.join(job.tempdir, 'test_salmon')
+        os.makedirs(out_dir)
+        open(os.path.join(out_dir, 'quant.sf'), 'w').close()
+        old_dir = os.path.join(job.outdir, 'test_salmon')
+        os.makedirs(old_dir)
+        open(os.path.join(old_dir, 'old.sf'), 'w').close()
+        job.add_output_file(out_dir)
+        write_script(job)
+        assert subprocess.call(['bash', job.filename]) == 0
+        assert os.listdir(old_dir) == ['quant.sf']
+
+    def test_all_in_outdir(self, job, write_script):
+        """Test that nothing is moved if every output is in the output
+        directory"""
+        job.add_output_file(os.path.join(job.outdir, 'c.txt'))
+        lines = write_script(job)
+        assert 'mv -f' not in lines
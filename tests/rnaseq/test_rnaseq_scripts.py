@@ -0,0 +1,119 @@
+import os
+import subprocess
+
+import pytest
+
+import cdpipelines as ps
+
+@pytest.fixture
+def job(make_job):
+    return make_job(ps.rnaseq.RNAJobScript)
+
+class TestRNAJobScriptSyntax:
+    def test_run(self, job, write_script):
+        """Test that a shell script with the RNA commands passes bash -n"""
+        star_out = job.star_align(
+            'r1.fastq.gz', 'r2.fastq.gz', 'ILLUMINA', 'flowcell_barcode',
+            'path/to/star/index', 4)
+        bam, transcriptome_bam = star_out[0], star_out[-1]
+        job.rsem_calculate_expression(transcriptome_bam, 'path/to/rsem/ref')
+        job.salmon_quant(transcriptome_bam, 'transcripts.fa')
+        job.bedgraph_from_bam(bam, bg=True)
+        job.bedgraph_from_bam(bam, strand='+', bg=True)
+        job.bedgraph_from_bam(bam, strand='-', scale=0.5)
+        job.add_lines('wait\n\n')
+        job.add_output_file(bam)
+        write_script(job)
+
+class TestStarFifoChain:
+    def test_run(self, job, write_script):
+        """Test that STAR streams its alignments through named pipes to
+        samtools sort and bammarkduplicates"""
+        star_bam = os.path.join(job.tempdir, 'test.bam')
+        sorted_bam = os.path.join(job.tempdir, 'test_sorted.bam')
+        job.add_lines('mkfifo {} {}\n\n'.format(star_bam, sorted_bam))
+        job.samtools_sort(star_bam, bg=True)
+        mdup_bam = job.biobambam2_mark_duplicates(sorted_bam, bg=True,
+                                                  index=True)[0]
+        star_out = job.star_align(
+            'r1.fastq.gz', 'r2.fastq.gz', 'ILLUMINA', 'flowcell_barcode',
+            'path/to/star/index', 4, stream_bam=True)
+        job.add_lines('wait\n\nrm {} {}\n\n'.format(star_bam, sorted_bam))
+        job.add_output_file(mdup_bam)
+        lines = write_script(job)
+        assert star_out[0] == star_bam
+        assert '--outStd BAM_Unsorted \\\n\t> {}\n'.format(star_bam) in lines
+        assert 'Aligned.out.bam' not in lines
+        assert lines.count(' &\n') == 2
+        assert (lines.index('mkfifo') < lines.index('--outStd') <
+                lines.index('wait'))
+
+    def test_bg(self, job, write_script):
+        """Test that the job exits if STAR fails in the background"""
+        fifo = os.path.join(job.tempdir, 'test.bam')
+        job.add_lines('mkfifo {}\n\n'.format(fifo))
+        job.add_lines('cat {} > /dev/null &\n\nreader_pid=$!\n\n'.format(
+            fifo))
+        job.star_align(
+            'r1.fastq.gz', 'r2.fastq.gz', 'ILLUMINA', 'flowcell_barcode',
+            'path/to/star/index', 4, stream_bam=True, star_path='false',
+            bg=True)
+        job.add_lines('star_pid=$!\n\n')
+        job.wait_for_background(['star_pid', 'reader_pid'], [fifo])
+        lines = write_script(job)
+        assert lines.count('(\nfalse \\\n') == 1
+        assert '> {} || exit 1\n'.format(fifo) in lines
+        assert subprocess.call(['timeout', '60', 'bash', job.filename]) == 1
+        assert not os.path.exists(fifo)
+
+class TestCountExitStatus:
+    def test_htseq_count(self, job, write_script):
+        """Test that the job exits if count.py fails"""
+        pytest.importorskip('HTSeq')
+        counts, stats = job.htseq_count('test.bam', 'test.gtf')
+        job.add_output_file(counts)
+        lines = write_script(job)
+        assert ('\'/^__/ {print > s; next} {print > c}\'\n\n'
+                'if [ "${PIPESTATUS[*]}" != "0 0" ] ; then exit 1 ; fi\n'
+               ) in lines
+
+    def test_dexseq_count(self, job, write_script):
+        """Test that the job exits if samtools or dexseq_count.py fails"""
+        counts = job.dexseq_count('test.bam', 'test.gff',
+                                  dexseq_count_path='dexseq_count.py')
+        job.add_output_file(counts)
+        lines = write_script(job)
+        assert (' {}\n\n'.format(counts) +
+                'if [ "${PIPESTATUS[*]}" != "0 0" ] ; then exit 1 ; fi\n'
+               ) in lines
+
+    def test_dexseq_count_featureCounts(self, job, write_script):
+        """Test that the job exits before the counts are reformatted if
+        featureCounts fails"""
+        counts = job.dexseq_count('test.bam', 'test.gff',
+                                  use_featureCounts=True)
+        job.add_output_file(counts)
+        lines = write_script(job)
+        assert (lines.index('if [ $? -ne 0 ] ; then exit 1 ; fi\n') <
+                lines.index('awk'))
+
+class TestPipelineOptions:
+    def test_quantifier(self):
+        """Test that an unknown quantifier is rejected"""
+        with pytest.raises(ValueError):
+            ps.rnaseq.pipeline(*([None] * 12), quantifier='kallisto')
+
+    def test_salmon_transcripts(self):
+        """Test that salmon needs the transcript sequences"""
+        with pytest.raises(ValueError):
+            ps.rnaseq.pipeline(*([None] * 12), quantifier='salmon')
+
+    def test_allele_counter(self):
+        """Test that an unknown allele counter is rejected"""
+        with pytest.raises(ValueError):
+            ps.rnaseq.pipeline(*([None] * 12), allele_counter='samtools')
+
+    def test_dexseq_counter(self):
+        """Test that an unknown DEXSeq counter is rejected"""
+        with pytest.raises(ValueError):
+            ps.rnaseq.pipeline(*([None] * 12), dexseq_counter='htseq')